@@ -0,0 +1,48 @@
+# 上流 JSON のデコード比較（旧: 検証で1回 + 呼び出し側で1回 / 新: 1回だけ）
+#
+#   python bench/bench_json.py
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import payloads
+from upstream import json_loads
+
+NUMBER = 200
+
+
+def run(label, fn, number=NUMBER):
+    best = min(timeit.repeat(fn, number=number, repeat=5)) / number
+    print(f"  {label:<28} {best * 1e6:9.1f} us")
+    return best
+
+
+def main():
+    print(f"decoder: {json_loads.__module__}.{json_loads.__name__}")
+    for name in payloads.RECORD_PATHS:
+        raw = payloads.load(name)
+        text = raw.decode()
+        print(f"{name} ({len(raw) // 1024} KiB)")
+
+        def old():
+            # 旧 api_request_core: r.text -> json.loads で検証、呼び出し側で再度 json.loads
+            json.loads(text)
+            json.loads(text)
+
+        def new_stdlib():
+            json.loads(raw)
+
+        def new_fast():
+            json_loads(raw)
+
+        base = run("old (stdlib x2)", old)
+        run("new (stdlib x1)", new_stdlib)
+        fast = run("new (json_loads x1)", new_fast)
+        print(f"  speedup: {base / fast:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+# Nitter 検索ページのパース比較（旧: BeautifulSoup + select / 新: lxml ツリーを1回走査）
+#
+#   python bench/bench_nitter.py [保存した.html ...]
+#
+# 引数が無ければ bench/payloads/nitter_search.html（無ければ合成ページ）を使う。
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import payloads
+from nitter import parse_x_tweets, parse_x_tweets_soup
+
+NUMBER = 20
+BASE = "https://nitter.example"
+
+
+def run(label, fn, number=NUMBER):
+    best = min(timeit.repeat(fn, number=number, repeat=5)) / number
+    print(f"  {label:<28} {best * 1e3:9.2f} ms")
+    return best
+
+
+def pages():
+    if len(sys.argv) > 1:
+        for path in sys.argv[1:]:
+            with open(path, encoding="utf-8") as f:
+                yield os.path.basename(path), f.read()
+    else:
+        yield payloads.NITTER_FILE, payloads.load_nitter()
+
+
+def main():
+    for name, html in pages():
+        old = parse_x_tweets_soup(html, BASE)
+        new = parse_x_tweets(html, BASE)
+        if old != new:
+            sys.exit(f"{name}: output differs")
+        print(f"{name} ({len(html) // 1024} KiB, {len(new)} tweets, output identical)")
+
+        base = run("old (BeautifulSoup)", lambda: parse_x_tweets_soup(html, BASE))
+        fast = run("new (lxml single pass)", lambda: parse_x_tweets(html, BASE))
+        print(f"  speedup: {base / fast:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
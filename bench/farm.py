@@ -0,0 +1,201 @@
+# ベンチ用の偽 Invidious / Nitter（ローカルで複数台立てる）
+#
+#   python bench/farm.py --invidious 5 --nitter 2 --latency 0.08 --sigma 0.5 --fail 0.02 --bad 1
+#
+# 応答は payloads.py の録ったもの（無ければ合成データ）をそのまま返す。
+# 台ごとの遅延は対数正規分布（中央値 --latency, ばらつき --sigma）。
+# --bad 台は --bad-fail の割合で失敗する（落ちているインスタンスの代わり）。
+# 各台の GET /_stats で呼ばれた回数、GET /_reset で0に戻せる。
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import sys
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import payloads
+
+REASONS = {200: "OK", 404: "Not Found", 502: "Bad Gateway"}
+
+
+def scale_payload(raw, scale):
+    # 一覧（検索結果・コメント・チャンネルの動画など）の件数を scale 倍にして大きさを変える
+    if scale == 1:
+        return raw
+    data = json.loads(raw)
+
+    def grow(items):
+        n = max(1, round(len(items) * scale))
+        return [items[i % len(items)] for i in range(n)] if items else items
+
+    if isinstance(data, list):
+        data = grow(data)
+    elif isinstance(data, dict):
+        for key in ("comments", "latestVideos", "recommendedVideos", "adaptiveFormats"):
+            if isinstance(data.get(key), list):
+                data[key] = grow(data[key])
+    return json.dumps(data, ensure_ascii=False).encode()
+
+
+class FakeServer:
+    def __init__(self, kind, port, latency, sigma, fail, fail_mode, bodies, seed):
+        self.kind = kind  # "invidious" / "nitter"
+        self.port = port
+        self.latency = latency
+        self.sigma = sigma
+        self.fail = fail
+        self.fail_mode = fail_mode  # "error"（502）/ "timeout"（応答しない）
+        self.bodies = bodies
+        self.rng = random.Random(seed)
+        self.calls = {}
+        self.failures = 0
+        self.server = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.port}/" if self.kind == "invidious" else f"http://127.0.0.1:{self.port}"
+
+    def route(self, path):
+        # -> (エンドポイント名, Content-Type, 本文) / 無ければ None
+        if self.kind == "nitter":
+            if path == "/search":
+                return "search", "text/html; charset=utf-8", self.bodies["nitter"]
+            return None
+        parts = path.strip("/").split("/")
+        if len(parts) >= 3 and parts[:2] == ["api", "v1"] and parts[2] in payloads.RECORD_PATHS:
+            return parts[2], "application/json", self.bodies[parts[2]]
+        return None
+
+    def delay(self):
+        if self.latency <= 0:
+            return 0
+        return self.latency * math.exp(self.rng.gauss(0, self.sigma))
+
+    def stats(self):
+        return {"calls": self.calls, "total": sum(self.calls.values()), "failures": self.failures}
+
+    async def respond(self, target):
+        path = urlsplit(target).path
+        if path == "/_stats":
+            return 200, "application/json", json.dumps(self.stats()).encode()
+        if path == "/_reset":
+            self.calls = {}
+            self.failures = 0
+            return 200, "application/json", b"{}"
+
+        found = self.route(path)
+        endpoint = found[0] if found else "unknown"
+        self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+        await asyncio.sleep(self.delay())
+        if found is None:
+            return 404, "text/plain", b"not found"
+        if self.rng.random() < self.fail:
+            self.failures += 1
+            if self.fail_mode == "timeout":
+                await asyncio.sleep(3600)
+            return 502, "text/plain", b"bad gateway"
+        return 200, found[1], found[2]
+
+    async def handle(self, reader, writer):
+        # HTTP/1.1 keep-alive（GET だけ）
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                method, target, _ = line.decode("latin-1").split(" ", 2)
+                close = False
+                while True:
+                    header = await reader.readline()
+                    if header in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = header.decode("latin-1").partition(":")
+                    if name.strip().lower() == "connection" and value.strip().lower() == "close":
+                        close = True
+                status, content_type, body = await self.respond(target)
+                writer.write(
+                    f"HTTP/1.1 {status} {REASONS.get(status, 'OK')}\r\n"
+                    f"Content-Type: {content_type}\r\n"
+                    f"Content-Length: {len(body)}\r\n"
+                    f"Connection: {'close' if close else 'keep-alive'}\r\n\r\n".encode("latin-1") + body
+                )
+                await writer.drain()
+                if close:
+                    break
+        except (ConnectionError, ValueError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", self.port)
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+
+def load_bodies(scale):
+    bodies = {name: scale_payload(payloads.load(name), scale) for name in payloads.RECORD_PATHS}
+    bodies["nitter"] = payloads.load_nitter().encode()
+    return bodies
+
+
+def build_farm(args):
+    bodies = load_bodies(args.scale)
+    servers = []
+    port = args.port
+    for i in range(args.invidious):
+        bad = i >= args.invidious - args.bad
+        servers.append(FakeServer(
+            "invidious", port, args.latency, args.sigma,
+            args.bad_fail if bad else args.fail, args.fail_mode, bodies, args.seed + i,
+        ))
+        port += 1
+    for i in range(args.nitter):
+        servers.append(FakeServer(
+            "nitter", port, args.latency, args.sigma, args.fail, args.fail_mode, bodies, args.seed + 1000 + i,
+        ))
+        port += 1
+    return servers
+
+
+def parser():
+    p = argparse.ArgumentParser(description="local fake Invidious / Nitter farm")
+    p.add_argument("--invidious", type=int, default=5, help="number of fake Invidious instances")
+    p.add_argument("--nitter", type=int, default=2, help="number of fake Nitter instances")
+    p.add_argument("--port", type=int, default=18000, help="first port (instances use consecutive ports)")
+    p.add_argument("--latency", type=float, default=0.08, help="median response delay in seconds")
+    p.add_argument("--sigma", type=float, default=0.5, help="log-normal spread of the delay")
+    p.add_argument("--fail", type=float, default=0.0, help="failure rate of healthy instances")
+    p.add_argument("--fail-mode", choices=("error", "timeout"), default="error")
+    p.add_argument("--bad", type=int, default=0, help="number of Invidious instances that mostly fail")
+    p.add_argument("--bad-fail", type=float, default=1.0, help="failure rate of the bad instances")
+    p.add_argument("--scale", type=float, default=1.0, help="multiply list lengths in the payloads")
+    p.add_argument("--seed", type=int, default=1)
+    return p
+
+
+async def serve(args):
+    servers = build_farm(args)
+    await asyncio.gather(*(s.start() for s in servers))
+    # 起動した URL を1行の JSON で知らせる（loadtest.py が読む）
+    print(json.dumps({
+        "invidious": [s.url for s in servers if s.kind == "invidious"],
+        "nitter": [s.url for s in servers if s.kind == "nitter"],
+    }), flush=True)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await asyncio.gather(*(s.stop() for s in servers))
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(serve(parser().parse_args()))
+    except KeyboardInterrupt:
+        pass
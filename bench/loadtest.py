@@ -0,0 +1,262 @@
+# 負荷試験（偽の上流 farm.py + 本物の main.py）
+#
+#   python bench/loadtest.py --concurrency 32 --duration 10
+#   python bench/loadtest.py --routes watch,search --keys 1000 --bad 2 --json after.json
+#
+# farm.py と uvicorn main:app を子プロセスで立て、ルートごとに一定の同時数で叩いて
+#   RPS / p50 / p99 / エラー数 / 1リクエストあたりの上流呼び出し数（amplification）
+# を出す。--json に書いた結果を --compare に渡すと前回との差も出す。
+# --keys はクエリや動画IDの種類数（小さいほどキャッシュが効く）。
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+
+import httpx
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+
+sys.path.insert(0, BENCH_DIR)
+
+import farm
+
+
+def video_id(i):
+    return f"{i:011d}"
+
+
+# ルート名 -> i 番目のキーに対するパス
+ROUTES = {
+    "home": lambda i: "/",
+    "search": lambda i: f"/search?q=bench{i}",
+    "watch": lambda i: f"/watch?v={video_id(i)}",
+    "comments": lambda i: f"/comments?v={video_id(i)}",
+    "x_search": lambda i: f"/x/search?q=bench{i}",
+}
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+# =========================
+# 子プロセス
+# =========================
+
+def start_farm(args):
+    command = [
+        sys.executable, os.path.join(BENCH_DIR, "farm.py"),
+        "--invidious", str(args.invidious), "--nitter", str(args.nitter), "--port", str(args.farm_port),
+        "--latency", str(args.latency), "--sigma", str(args.sigma), "--fail", str(args.fail),
+        "--fail-mode", args.fail_mode, "--bad", str(args.bad), "--bad-fail", str(args.bad_fail),
+        "--scale", str(args.scale), "--seed", str(args.seed),
+    ]
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    urls = json.loads(proc.stdout.readline())
+    return proc, urls
+
+
+def start_app(args, urls, port):
+    env = dict(
+        os.environ,
+        INVIDIOUS_INSTANCES=",".join(urls["invidious"]),
+        NITTER_INSTANCES=",".join(urls["nitter"]),
+        PROBE="1" if args.probe else "0",
+        BACKGROUND_REFRESH="1" if args.background else "0",
+        METRICS_PUBLIC="1",
+    )
+    command = [
+        sys.executable, "-m", "uvicorn", args.app, "--host", "127.0.0.1", "--port", str(port),
+        "--log-level", "warning", "--no-access-log",
+    ]
+    # アプリのログは表と混ざるので --app-log に書く（既定は捨てる）
+    log = open(args.app_log, "ab")
+    try:
+        return subprocess.Popen(command, cwd=ROOT, env=env, stdout=log, stderr=log)
+    finally:
+        log.close()
+
+
+async def wait_ready(client, base, proc, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError("app exited during startup")
+        try:
+            await client.get(base + "/metrics")
+            return
+        except httpx.TransportError:
+            await asyncio.sleep(0.2)
+    raise RuntimeError("app did not start")
+
+
+# =========================
+# 計測
+# =========================
+
+async def farm_calls(client, urls):
+    total = 0
+    for url in urls["invidious"] + urls["nitter"]:
+        r = await client.get(url.rstrip("/") + "/_stats")
+        total += r.json()["total"]
+    return total
+
+
+async def farm_reset(client, urls):
+    for url in urls["invidious"] + urls["nitter"]:
+        await client.get(url.rstrip("/") + "/_reset")
+
+
+async def run_route(client, base, name, args, rng):
+    path = ROUTES[name]
+    latencies = []
+    errors = 0
+    sent = 0
+    deadline = time.monotonic() + args.duration
+
+    async def user():
+        nonlocal errors, sent
+        while time.monotonic() < deadline and (not args.requests or sent < args.requests):
+            sent += 1
+            start = time.monotonic()
+            try:
+                r = await client.get(base + path(rng.randrange(args.keys)))
+                await r.aread()
+                if r.status_code >= 400:
+                    errors += 1
+            except httpx.HTTPError:
+                errors += 1
+            latencies.append(time.monotonic() - start)
+
+    start = time.monotonic()
+    await asyncio.gather(*(user() for _ in range(args.concurrency)))
+    return latencies, errors, time.monotonic() - start
+
+
+async def bench(args):
+    farm_proc, urls = start_farm(args)
+    port = args.app_port or free_port()
+    base = f"http://127.0.0.1:{port}"
+    app_proc = start_app(args, urls, port)
+    rng = random.Random(args.seed)
+    results = {}
+    limits = httpx.Limits(max_connections=args.concurrency + 4, max_keepalive_connections=args.concurrency + 4)
+    try:
+        async with httpx.AsyncClient(cookies={"sennin": "True"}, limits=limits, timeout=60) as client:
+            await wait_ready(client, base, app_proc)
+            for name in args.routes:
+                if args.cold:
+                    # ルートごとにアプリを立て直すとキャッシュ無しの状態から測れる
+                    app_proc.terminate()
+                    app_proc.wait()
+                    app_proc = start_app(args, urls, port)
+                    await wait_ready(client, base, app_proc)
+                await farm_reset(client, urls)
+                latencies, errors, elapsed = await run_route(client, base, name, args, rng)
+                calls = await farm_calls(client, urls)
+                n = len(latencies)
+                results[name] = {
+                    "requests": n,
+                    "errors": errors,
+                    "rps": n / elapsed if elapsed else 0.0,
+                    "p50_ms": percentile(latencies, 0.50) * 1000,
+                    "p99_ms": percentile(latencies, 0.99) * 1000,
+                    "upstream_calls": calls,
+                    "amplification": calls / n if n else 0.0,
+                }
+                print_row(name, results[name])
+    finally:
+        app_proc.terminate()
+        farm_proc.terminate()
+        app_proc.wait()
+        farm_proc.wait()
+    return results
+
+
+# =========================
+# 出力
+# =========================
+
+HEADER = f"{'route':<10} {'reqs':>7} {'errors':>7} {'rps':>9} {'p50 ms':>9} {'p99 ms':>9} {'upstream':>9} {'amp':>7}"
+
+
+def print_row(name, r, before=None):
+    line = (f"{name:<10} {r['requests']:>7} {r['errors']:>7} {r['rps']:>9.1f} {r['p50_ms']:>9.1f} "
+            f"{r['p99_ms']:>9.1f} {r['upstream_calls']:>9} {r['amplification']:>7.2f}")
+    if before:
+        def change(key):
+            old = before[key]
+            return f"{(r[key] - old) / old * 100:+.0f}%" if old else "n/a"
+        line += f"   rps {change('rps')} p99 {change('p99_ms')} amp {change('amplification')}"
+    print(line)
+
+
+def parser():
+    p = argparse.ArgumentParser(description="load test main.py against a local fake upstream farm")
+    p.add_argument("--app", default="main:app", help="ASGI app to start with uvicorn")
+    p.add_argument("--routes", default=",".join(ROUTES), help=f"comma separated: {', '.join(ROUTES)}")
+    p.add_argument("--concurrency", type=int, default=16)
+    p.add_argument("--duration", type=float, default=10, help="seconds per route")
+    p.add_argument("--requests", type=int, default=0, help="stop a route after this many requests (0 = duration only)")
+    p.add_argument("--keys", type=int, default=200, help="distinct queries / video ids per route")
+    p.add_argument("--cold", action="store_true", help="restart the app before each route")
+    p.add_argument("--probe", action="store_true", help="keep the background health prober on")
+    p.add_argument("--background", action="store_true", help="keep background refresh and prefetch on")
+    p.add_argument("--app-port", type=int, default=0)
+    p.add_argument("--app-log", default=os.devnull, help="file for the app's stdout/stderr")
+    p.add_argument("--farm-port", type=int, default=18000)
+    p.add_argument("--json", help="write the results to this file")
+    p.add_argument("--compare", help="earlier --json output to compare against")
+    # 上流の設定は farm.py と同じ
+    for action in farm.parser()._actions:
+        if action.dest in ("help", "port"):
+            continue
+        p.add_argument(*action.option_strings, dest=action.dest, type=action.type, default=action.default,
+                       choices=action.choices, help=action.help)
+    return p
+
+
+def main():
+    args = parser().parse_args()
+    args.routes = [r.strip() for r in args.routes.split(",") if r.strip()]
+    unknown = [r for r in args.routes if r not in ROUTES]
+    if unknown:
+        sys.exit(f"unknown route: {', '.join(unknown)}")
+
+    print(f"farm: {args.invidious} invidious + {args.nitter} nitter, latency {args.latency}s sigma {args.sigma}, "
+          f"fail {args.fail}, bad {args.bad}, scale {args.scale}")
+    print(f"load: concurrency {args.concurrency}, {args.duration}s per route, {args.keys} keys")
+    print(HEADER)
+    results = asyncio.run(bench(args))
+
+    if args.compare:
+        with open(args.compare) as f:
+            before = json.load(f)["results"]
+        print("\ncompared with", args.compare)
+        print(HEADER)
+        for name, r in results.items():
+            print_row(name, r, before.get(name))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"config": {k: v for k, v in vars(args).items() if k not in ("json", "compare")},
+                       "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+# ベンチ用の Invidious / Nitter 応答
+#
+#   python bench/payloads.py record https://inv.example/   実インスタンスから録る
+#
+# bench/payloads/ に録ったファイルがあればそれを使い、無ければ
+# 実際の応答と同じ形・同程度の大きさの合成データを返す。
+import json
+import os
+import random
+import string
+import sys
+
+DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "payloads")
+
+SAMPLE_VIDEO_ID = "jNQXAC9IVRw"
+SAMPLE_CHANNEL_ID = "UC4QobU6STFB0P71PMvOGN5A"
+
+# 名前 -> (Invidious のパス, 保存ファイル名)
+RECORD_PATHS = {
+    "videos": (f"api/v1/videos/{SAMPLE_VIDEO_ID}?hl=jp", "videos.json"),
+    "search": ("api/v1/search?q=music&page=1&hl=jp", "search.json"),
+    "popular": ("api/v1/popular?hl=jp", "popular.json"),
+    "comments": (f"api/v1/comments/{SAMPLE_VIDEO_ID}?hl=jp", "comments.json"),
+    "channels": (f"api/v1/channels/{SAMPLE_CHANNEL_ID}", "channels.json"),
+}
+NITTER_FILE = "nitter_search.html"
+
+rng = random.Random(1234)
+
+
+def word(n=8):
+    return "".join(rng.choice(string.ascii_letters) for _ in range(n))
+
+
+def video_id():
+    return "".join(rng.choice(string.ascii_letters + string.digits + "-_") for _ in range(11))
+
+
+def stream_url(itag):
+    q = "&".join(f"{word(4)}={word(24)}" for _ in range(18))
+    return f"https://rr3---sn-{word(8)}.googlevideo.com/videoplayback?expire=4102444800&itag={itag}&{q}"
+
+
+def thumbs(n=4):
+    return [{"quality": word(6), "url": f"https://i.ytimg.com/vi/{video_id()}/{word(6)}.jpg", "width": 320, "height": 180} for _ in range(n)]
+
+
+def author_thumbs():
+    return [{"url": f"https://yt3.ggpht.com/{word(60)}=s{s}-c-k", "width": s, "height": s} for s in (32, 48, 76, 100, 176, 512)]
+
+
+def video_item():
+    return {
+        "type": "video", "title": word(40), "videoId": video_id(), "author": word(12),
+        "authorId": "UC" + word(22), "authorUrl": "/channel/UC" + word(22), "authorVerified": False,
+        "videoThumbnails": thumbs(9), "description": word(160), "descriptionHtml": word(180),
+        "viewCount": rng.randint(0, 10**7), "viewCountText": "1万 回視聴", "published": 1700000000,
+        "publishedText": "1 日前", "lengthSeconds": rng.randint(30, 3600), "liveNow": False,
+        "premium": False, "isUpcoming": False, "isNew": False, "is4k": False, "hasCaptions": True,
+    }
+
+
+def synth_videos():
+    adaptive = []
+    for itag, mime, h in [(137, "video/mp4", 1080), (248, "video/webm", 1080), (136, "video/mp4", 720),
+                          (247, "video/webm", 720), (135, "video/mp4", 480), (244, "video/webm", 480),
+                          (134, "video/mp4", 360), (243, "video/webm", 360), (133, "video/mp4", 240),
+                          (242, "video/webm", 240), (160, "video/mp4", 144), (278, "video/webm", 144)]:
+        codec = "avc1.640028" if "mp4" in mime else "vp9"
+        adaptive.append({
+            "init": "0-740", "index": "741-1500", "bitrate": str(h * 2000), "url": stream_url(itag),
+            "itag": str(itag), "type": f'{mime}; codecs="{codec}"', "clen": str(h * 40000),
+            "lmt": "1700000000000000", "projectionType": "RECTANGULAR", "fps": 30, "container": mime[6:],
+            "encoding": codec.split(".")[0], "resolution": f"{h}p", "qualityLabel": f"{h}p",
+            "size": f"{h * 16 // 9}x{h}", "height": h, "width": h * 16 // 9,
+        })
+    for itag, br in [(140, 130000), (251, 160000), (250, 70000), (249, 50000)]:
+        adaptive.append({
+            "init": "0-631", "index": "632-1000", "bitrate": str(br), "url": stream_url(itag),
+            "itag": str(itag), "type": 'audio/mp4; codecs="mp4a.40.2"' if itag == 140 else 'audio/webm; codecs="opus"',
+            "clen": str(br * 30), "lmt": "1700000000000000", "container": "m4a" if itag == 140 else "webm",
+            "encoding": "aac" if itag == 140 else "opus", "audioQuality": "AUDIO_QUALITY_MEDIUM",
+            "audioSampleRate": 48000, "audioChannels": 2,
+        })
+    return {
+        "type": "video", "title": word(40), "videoId": SAMPLE_VIDEO_ID, "videoThumbnails": thumbs(9),
+        "storyboards": [{"url": "/api/v1/storyboards/x", "templateUrl": stream_url(0)} for _ in range(3)],
+        "description": word(2000), "descriptionHtml": word(2400), "published": 1700000000,
+        "publishedText": "1 年前", "keywords": [word(8) for _ in range(30)], "viewCount": 10**6,
+        "likeCount": 10**4, "dislikeCount": 0, "paid": False, "premium": False, "isFamilyFriendly": True,
+        "allowedRegions": [word(2).upper() for _ in range(240)], "genre": "Music", "genreUrl": None,
+        "author": word(12), "authorId": SAMPLE_CHANNEL_ID, "authorUrl": "/channel/" + SAMPLE_CHANNEL_ID,
+        "authorVerified": False, "authorThumbnails": author_thumbs(), "subCountText": "100万",
+        "lengthSeconds": 213, "allowRatings": True, "rating": 0, "isListed": True, "liveNow": False,
+        "isPostLiveDvr": False, "isUpcoming": False, "dashUrl": "https://inv.example/api/manifest/dash/id/x",
+        "adaptiveFormats": adaptive,
+        "formatStreams": [{"url": stream_url(18), "itag": "18", "type": 'video/mp4; codecs="avc1.42001E, mp4a.40.2"',
+                           "quality": "medium", "bitrate": "500000", "fps": 30, "size": "640x360",
+                           "resolution": "360p", "qualityLabel": "360p", "container": "mp4", "encoding": "h264"}],
+        "captions": [{"label": word(8), "language_code": "ja", "url": "/api/v1/captions/x"} for _ in range(5)],
+        "recommendedVideos": [{
+            "videoId": video_id(), "title": word(40), "videoThumbnails": thumbs(9), "author": word(12),
+            "authorUrl": "/channel/UC" + word(22), "authorId": "UC" + word(22), "authorVerified": False,
+            "authorThumbnails": author_thumbs(), "lengthSeconds": 200, "viewCount": 1000, "viewCountText": "1,000",
+        } for _ in range(20)],
+    }
+
+
+def synth_comments():
+    return {
+        "commentCount": 2000, "videoId": SAMPLE_VIDEO_ID,
+        "comments": [{
+            "authorId": "UC" + word(22), "authorUrl": "/channel/UC" + word(22), "author": "@" + word(10),
+            "verified": False, "authorThumbnails": author_thumbs(), "authorIsChannelOwner": False,
+            "isSponsor": False, "likeCount": rng.randint(0, 999), "isPinned": False, "isEdited": False,
+            "content": word(200), "contentHtml": word(220), "published": 1700000000,
+            "publishedText": "1 年前", "commentId": word(26),
+            "replies": {"replyCount": 3, "continuation": word(120)},
+        } for _ in range(20)],
+        "continuation": word(160),
+    }
+
+
+def synth_channels():
+    return {
+        "author": word(12), "authorId": SAMPLE_CHANNEL_ID, "authorUrl": "/channel/" + SAMPLE_CHANNEL_ID,
+        "authorVerified": False, "authorBanners": [{"url": f"https://yt3.ggpht.com/{word(80)}", "width": w, "height": w // 6} for w in (2560, 2120, 1060, 512)],
+        "authorThumbnails": author_thumbs(), "subCount": 10**6, "totalViews": 10**8, "joined": 1100000000,
+        "autoGenerated": False, "isFamilyFriendly": True, "description": word(600), "descriptionHtml": word(700),
+        "allowedRegions": [word(2).upper() for _ in range(240)], "tabs": ["videos", "shorts", "playlists"],
+        "latestVideos": [dict(video_item(), published=1700000000 - i * 86400) for i in range(30)],
+        "relatedChannels": [],
+    }
+
+
+def synth_nitter():
+    items = []
+    for i in range(20):
+        media = ""
+        if i % 3 == 0:
+            media = (f'<div class="attachments"><div class="gallery-row"><div class="attachment image">'
+                     f'<a class="still-image" href="/pic/orig/media%2F{word(15)}.jpg" target="_blank">'
+                     f'<img src="/pic/media%2F{word(15)}.jpg%3Fname%3Dsmall" alt="" loading="lazy"></a></div></div></div>')
+        elif i % 5 == 1:
+            media = (f'<div class="attachments card"><div class="gallery-video"><div class="attachment video-container">'
+                     f'<video poster="/pic/{word(20)}.jpg" data-url="/video/{word(30)}" preload="none" controls>'
+                     f'<source src="https://video.twimg.com/ext_tw_video/{word(19)}/pu/vid/720x1280/{word(16)}.mp4" type="video/mp4"></video>'
+                     f'</div></div></div>')
+        items.append(
+            f'<div class="timeline-item " data-username="{word(8)}"><a class="tweet-link" href="/{word(8)}/status/{rng.randint(10**17, 10**18)}#m"></a>'
+            f'<div class="tweet-body"><div><div class="tweet-header"><a class="tweet-avatar" href="/{word(8)}">'
+            f'<img class="avatar round" src="/pic/profile_images%2F{word(19)}%2F{word(8)}_bigger.jpg" alt="" loading="lazy"></a>'
+            f'<div class="tweet-name-row"><div class="fullname-and-username"><a class="fullname" href="/{word(8)}" title="{word(8)}">{word(8)}</a>'
+            f'<a class="username" href="/{word(8)}" title="@{word(8)}">@{word(8)}</a></div>'
+            f'<span class="tweet-date"><a href="/{word(8)}/status/1#m" title="Jan 1, 2026 · 0:00 AM UTC">1h</a></span></div></div></div>'
+            f'<div class="tweet-content media-body" dir="auto">{word(60)} <a href="/search?q=%23{word(6)}">#{word(6)}</a><br>{word(40)}</div>'
+            f'{media}<div class="tweet-stats"><span class="tweet-stat"><div class="icon-container"><span class="icon-comment" title=""></span> 1</div></span>'
+            f'<span class="tweet-stat"><div class="icon-container"><span class="icon-retweet" title=""></span> 2</div></span>'
+            f'<span class="tweet-stat"><div class="icon-container"><span class="icon-heart" title=""></span> 3</div></span></div></div></div>'
+        )
+    return (
+        '<!DOCTYPE html><html lang="en"><head><meta charset="utf-8"><title>Search | nitter</title>'
+        '<link rel="stylesheet" type="text/css" href="/css/style.css?v=19"></head><body><nav><div class="inner-nav">'
+        '<div class="nav-item"><a class="site-name" href="/">nitter</a></div></div></nav><div class="container">'
+        '<div class="timeline-container"><div class="timeline">' + "".join(items) +
+        '<div class="show-more"><a href="?f=tweets&q=x&cursor=' + word(80) + '">Load more</a></div></div></div></div></body></html>'
+    )
+
+
+SYNTH = {
+    "videos": synth_videos,
+    "search": lambda: [video_item() for _ in range(20)],
+    "popular": lambda: [video_item() for _ in range(40)],
+    "comments": synth_comments,
+    "channels": synth_channels,
+}
+
+
+def load(name):
+    # 録ったものがあれば bytes をそのまま、無ければ合成データ
+    path = os.path.join(DIR, RECORD_PATHS[name][1])
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            return f.read()
+    return json.dumps(SYNTH[name](), ensure_ascii=False).encode()
+
+
+def load_nitter():
+    path = os.path.join(DIR, NITTER_FILE)
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            return f.read()
+    return synth_nitter()
+
+
+def record(instance, nitter=None):
+    import httpx
+
+    os.makedirs(DIR, exist_ok=True)
+    with httpx.Client(headers={"User-Agent": "Mozilla/5.0"}, timeout=15, follow_redirects=True) as client:
+        for name, (path, filename) in RECORD_PATHS.items():
+            r = client.get(instance.rstrip("/") + "/" + path)
+            r.raise_for_status()
+            json.loads(r.content)
+            with open(os.path.join(DIR, filename), "wb") as f:
+                f.write(r.content)
+            print(f"{name}: {len(r.content)} bytes")
+        if nitter:
+            r = client.get(nitter.rstrip("/") + "/search?f=tweets&q=music")
+            r.raise_for_status()
+            with open(os.path.join(DIR, NITTER_FILE), "w", encoding="utf-8") as f:
+                f.write(r.text)
+            print(f"nitter: {len(r.text)} bytes")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 3 and sys.argv[1] == "record":
+        record(sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else None)
+    else:
+        print("usage: python bench/payloads.py record <invidious> [nitter]")
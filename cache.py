@@ -1,37 +1,135 @@
-from functools import lru_cache, wraps
+from collections import OrderedDict, namedtuple
+from functools import wraps
 from threading import Lock
+import asyncio
+import inspect
 import time
 
 
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "inflight", "maxsize", "currsize", "evictions", "coalesced"])
+
+# @cache を付けた関数の一覧（/metrics で統計を読む）
+cached_functions = []
+
+_kwd_mark = object()
+
+
+def _make_key(args, kwargs, typed):
+    # lru_cache と同じ考え方でキーを作る（kwargs は順序に依存しないよう整列）
+    key = args
+    if kwargs:
+        key += (_kwd_mark,) + tuple(sorted(kwargs.items()))
+    if typed:
+        key += tuple(type(v) for v in args)
+        if kwargs:
+            key += tuple(type(v) for _, v in sorted(kwargs.items()))
+    return key
+
+
 def cache(seconds: int, max_size: int = 128, typed: bool = False):
     def wrapper(f):
         # 1関数につき1つのLockを共有
         lock = Lock()
 
-        # lru_cacheを適用
-        func = lru_cache(maxsize=max_size, typed=typed)(f)
+        # key -> (期限, 値)。末尾ほど最近使われたもの
+        entries = OrderedDict()
+        # key -> 実行中の Task（async 用・同時リクエストの重複排除）
+        inflight = {}
+        stats = {"hits": 0, "misses": 0, "evictions": 0, "coalesced": 0}
 
-        # TTL（秒）
-        func.ttl = seconds
-        # 単調増加クロックで期限を管理
-        func.expire = time.monotonic() + func.ttl
+        def lookup(key, now):
+            with lock:
+                entry = entries.get(key)
+                if entry is not None:
+                    if now < entry[0]:
+                        entries.move_to_end(key)
+                        stats["hits"] += 1
+                        return True, entry[1]
+                    # エントリ単位で期限切れ
+                    del entries[key]
+            return False, None
 
-        @wraps(f)
-        def inner(*args, **kwargs):
-            now = time.monotonic()
+        def store(key, value):
+            with lock:
+                entries[key] = (time.monotonic() + seconds, value)
+                entries.move_to_end(key)
+                while max_size is not None and len(entries) > max_size:
+                    entries.popitem(last=False)
+                    stats["evictions"] += 1
 
-            # TTL判定とクリアを排他制御
+        if inspect.iscoroutinefunction(f):
+            async def run(key, args, kwargs):
+                try:
+                    value = await f(*args, **kwargs)
+                    store(key, value)
+                    return value
+                finally:
+                    inflight.pop(key, None)
+
+            @wraps(f)
+            async def inner(*args, **kwargs):
+                key = _make_key(args, kwargs, typed)
+                hit, value = lookup(key, time.monotonic())
+                if hit:
+                    return value
+
+                # 同じキーが取得中ならその結果を待つ（single-flight）
+                task = inflight.get(key)
+                if task is None:
+                    with lock:
+                        stats["misses"] += 1
+                    task = asyncio.ensure_future(run(key, args, kwargs))
+                    inflight[key] = task
+                else:
+                    # 取得中への相乗りはヒットとは別に数える（hits は取得済みの値を返せた時だけ）
+                    with lock:
+                        stats["coalesced"] += 1
+
+                # 呼び出し元がキャンセルされても取得自体は他の待機者のために続ける
+                return await asyncio.shield(task)
+
+            async def refresh(*args, **kwargs):
+                # 期限に関係なく取り直して差し替える（バックグラウンド更新用）
+                key = _make_key(args, kwargs, typed)
+                task = inflight.get(key)
+                if task is None:
+                    task = asyncio.ensure_future(run(key, args, kwargs))
+                    inflight[key] = task
+                return await asyncio.shield(task)
+
+            inner.refresh = refresh
+        else:
+            @wraps(f)
+            def inner(*args, **kwargs):
+                key = _make_key(args, kwargs, typed)
+                hit, value = lookup(key, time.monotonic())
+                if hit:
+                    return value
+                with lock:
+                    stats["misses"] += 1
+                value = f(*args, **kwargs)
+                store(key, value)
+                return value
+
+        def cache_clear():
             with lock:
-                if now > func.expire:
-                    func.cache_clear()
-                    func.expire = now + func.ttl
+                entries.clear()
+                stats["hits"] = 0
+                stats["misses"] = 0
+                stats["evictions"] = 0
+                stats["coalesced"] = 0
 
-            # キャッシュされた関数を呼び出す
-            return func(*args, **kwargs)
+        def cache_info():
+            with lock:
+                return CacheInfo(stats["hits"], stats["misses"], len(inflight), max_size, len(entries), stats["evictions"],
+                                 stats["coalesced"])
 
         # 外部から操作できるよう公開
-        inner.clear_cache = func.cache_clear
-        inner.cache_info = func.cache_info
+        inner.ttl = seconds
+        inner.clear_cache = cache_clear
+        inner.cache_clear = cache_clear
+        inner.cache_info = cache_info
+        cached_functions.append(inner)
 
         return inner
 
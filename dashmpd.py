@@ -0,0 +1,78 @@
+from xml.sax.saxutils import escape, quoteattr
+
+
+# =========================
+# DASH マニフェスト（MPD）生成
+# =========================
+#
+# adaptiveFormats の init/index の範囲から SegmentBase 形式の静的MPDを作る。
+# プレイヤーが回線速度に合わせて画質を切り替えられ、サーバー側での結合は不要。
+# BaseURL は既定で googlevideo のURLそのもの（expire までしか使えない）。
+
+AUDIO_CHANNEL_SCHEME = "urn:mpeg:dash:23003:3:audio_channel_configuration:2011"
+
+
+def attrs(**values):
+    return "".join(f" {k}={quoteattr(str(v))}" for k, v in values.items() if v is not None)
+
+
+def adaptation_sets(formats):
+    # mimeType ごとに1つの AdaptationSet（mp4 と webm は混ぜられない）
+    groups = {}
+    for f in formats:
+        kind = f.container.split("/", 1)[0]
+        if kind == "audio" and not f.default_audio:
+            # 吹き替えなどの追加音声は除く
+            continue
+        if kind in ("audio", "video") and f.codecs:
+            groups.setdefault(f.container, []).append(f)
+    # 映像 -> 音声、同じ種類なら mp4 を先に
+    return sorted(groups.items(), key=lambda g: (not g[0].startswith("video/"), "mp4" not in g[0]))
+
+
+def representation(f, url):
+    kind = f.container.split("/", 1)[0]
+    if kind == "video":
+        head = attrs(id=f.itag, codecs=f.codecs, bandwidth=f.bitrate, width=f.width, height=f.height, frameRate=f.fps)
+    else:
+        head = attrs(id=f.itag, codecs=f.codecs, bandwidth=f.bitrate, audioSamplingRate=f.sample_rate)
+    lines = [f"      <Representation{head}>"]
+    if kind == "audio":
+        lines.append(f"        <AudioChannelConfiguration{attrs(schemeIdUri=AUDIO_CHANNEL_SCHEME, value=f.channels or 2)}/>")
+    lines.append(f"        <BaseURL>{escape(url(f))}</BaseURL>")
+    lines.append(f"        <SegmentBase{attrs(indexRange=f.index_range)}>")
+    lines.append(f"          <Initialization{attrs(range=f.init_range)}/>")
+    lines.append("        </SegmentBase>")
+    lines.append("      </Representation>")
+    return lines
+
+
+def build_mpd(video, url=None):
+    # video: models.Video / url: Format -> BaseURL（中継させる時用）。使える形式が無ければ None
+    url = url or (lambda f: f.url)
+    sets = adaptation_sets(video.segmented)
+    if not any(mime.startswith("video/") for mime, _ in sets):
+        return None
+
+    lines = [
+        '<?xml version="1.0" encoding="UTF-8"?>',
+        "<MPD" + attrs(
+            xmlns="urn:mpeg:dash:schema:mpd:2011",
+            profiles="urn:mpeg:dash:profile:isoff-on-demand:2011",
+            type="static",
+            mediaPresentationDuration=f"PT{video.length_seconds}S",
+            minBufferTime="PT1.5S",
+        ) + ">",
+        "  <Period" + attrs(id="0", start="PT0S") + ">",
+    ]
+    for i, (mime, formats) in enumerate(sets):
+        kind = mime.split("/", 1)[0]
+        lines.append("    <AdaptationSet" + attrs(
+            id=i, contentType=kind, mimeType=mime, subsegmentAlignment="true", subsegmentStartsWithSAP=1,
+        ) + ">")
+        for f in sorted(formats, key=lambda f: f.bitrate):
+            lines.extend(representation(f, url))
+        lines.append("    </AdaptationSet>")
+    lines.append("  </Period>")
+    lines.append("</MPD>")
+    return "\n".join(lines) + "\n"
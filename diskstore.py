@@ -0,0 +1,168 @@
+from collections import OrderedDict
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+
+
+# =========================
+# 内容アドレス型ディスクキャッシュ（容量上限つき LRU）
+# =========================
+#
+# directory/
+#   blobs/ab/<sha256>   本体（同じ内容は1ファイルを共有）
+#   keys/<sha1(key)>    {"key": ..., "digest": ..., "size": ...}
+
+class DiskStore:
+    def __init__(self, directory, max_bytes, ttl=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.index = OrderedDict()  # key -> (digest, size, 保存時刻)。末尾ほど最近使われた
+        self.refs = {}              # digest -> 参照しているキー数
+        self.size = 0
+        self.inflight = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(os.path.join(directory, "keys"), exist_ok=True)
+        os.makedirs(os.path.join(directory, "blobs"), exist_ok=True)
+        self.load()
+
+    def key_path(self, key):
+        return os.path.join(self.directory, "keys", hashlib.sha1(key.encode()).hexdigest())
+
+    def blob_path(self, digest):
+        return os.path.join(self.directory, "blobs", digest[:2], digest)
+
+    def load(self):
+        # 起動時に一度だけ走査して索引を作る（古い順に並べて LRU 順を復元）
+        found = []
+        keys_dir = os.path.join(self.directory, "keys")
+        for name in os.listdir(keys_dir):
+            path = os.path.join(keys_dir, name)
+            try:
+                with open(path) as f:
+                    meta = json.load(f)
+                if not os.path.isfile(self.blob_path(meta["digest"])):
+                    raise ValueError("missing blob")
+                found.append((os.path.getmtime(path), meta))
+            except (OSError, ValueError, KeyError):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        for mtime, meta in sorted(found, key=lambda x: x[0]):
+            self.add(meta["key"], meta["digest"], meta["size"], mtime)
+        self.evict()
+
+    def add(self, key, digest, size, stored_at):
+        # 先に新しい参照を足す（同じ内容で上書きしたとき本体を消さないため）
+        refs = self.refs.get(digest, 0)
+        self.refs[digest] = refs + 1
+        if refs == 0:
+            self.size += size
+        old = self.index.pop(key, None)
+        if old is not None:
+            self.release(old[0], old[1])
+        self.index[key] = (digest, size, stored_at)
+
+    def release(self, digest, size):
+        refs = self.refs.get(digest, 0) - 1
+        if refs > 0:
+            self.refs[digest] = refs
+            return
+        self.refs.pop(digest, None)
+        self.size -= size
+        try:
+            os.remove(self.blob_path(digest))
+        except OSError:
+            pass
+
+    def remove(self, key):
+        entry = self.index.pop(key, None)
+        if entry is None:
+            return
+        self.release(entry[0], entry[1])
+        try:
+            os.remove(self.key_path(key))
+        except OSError:
+            pass
+
+    def evict(self):
+        while self.size > self.max_bytes and self.index:
+            key = next(iter(self.index))
+            self.remove(key)
+            self.evictions += 1
+
+    def get(self, key):
+        # 返り値: (ファイルパス, digest, サイズ) または None
+        entry = self.index.get(key)
+        if entry is None:
+            return None
+        digest, size, stored_at = entry
+        if self.ttl is not None and time.time() - stored_at > self.ttl:
+            self.remove(key)
+            return None
+        self.index.move_to_end(key)
+        return self.blob_path(digest), digest, size
+
+    async def put(self, key, chunks):
+        # chunks（async iterator）を一時ファイルへ書きながらハッシュを計算
+        h = hashlib.sha256()
+        size = 0
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                async for chunk in chunks:
+                    f.write(chunk)
+                    h.update(chunk)
+                    size += len(chunk)
+            digest = h.hexdigest()
+            path = self.blob_path(digest)
+            if os.path.exists(path):
+                os.remove(tmp)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(tmp, path)
+        except BaseException:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+
+        stored_at = time.time()
+        try:
+            with open(self.key_path(key), "w") as f:
+                json.dump({"key": key, "digest": digest, "size": size}, f)
+        except OSError as e:
+            logging.warning(f"disk cache index write failed: {e}")
+        self.add(key, digest, size, stored_at)
+        self.evict()
+        return self.get(key)
+
+    async def get_or_fetch(self, key, fetch):
+        # fetch() は chunks（async iterator）を返す関数。同じキーの同時取得は1回にまとめる
+        entry = self.get(key)
+        if entry is not None:
+            self.hits += 1
+            return entry
+
+        task = self.inflight.get(key)
+        if task is None:
+            self.misses += 1
+
+            async def run():
+                try:
+                    return await self.put(key, fetch())
+                finally:
+                    self.inflight.pop(key, None)
+
+            task = self.inflight[key] = asyncio.ensure_future(run())
+        else:
+            self.hits += 1
+        return await asyncio.shield(task)
@@ -0,0 +1,87 @@
+from collections import OrderedDict
+import asyncio
+import time
+
+
+# =========================
+# 登録チャンネルの新着フィード
+# =========================
+#
+# チャンネルごとに最近の動画を覚えておき、ttl 以内ならそのまま使う（上流へは行かない）。
+# 期限切れのものだけ同時 concurrency 件まで取り直し、前回分と videoId で重ねて
+# per_channel 件まで残す（latestVideos から外れた古い動画もしばらく残る）。
+# 最後に全チャンネル分を published の新しい順に並べる。
+#
+# fetch: async (channel_id) -> [{"id": ..., "published": UNIX秒, ...}, ...]
+
+class ChannelFeed:
+    def __init__(self, fetch, ttl=600, per_channel=30, concurrency=4, max_channels=4096):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.per_channel = per_channel
+        self.concurrency = concurrency
+        self.max_channels = max_channels
+        self.entries = OrderedDict()  # channel_id -> (videos, 取得時刻)
+        self.inflight = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def merge(self, channel_id, videos):
+        old = self.entries.get(channel_id)
+        seen = {v["id"]: v for v in (old[0] if old else [])}
+        # 新しい方の値で上書き（再生数などが更新される）
+        seen.update((v["id"], v) for v in videos)
+        merged = sorted(seen.values(), key=lambda v: v.get("published") or 0, reverse=True)
+        self.entries[channel_id] = (merged[:self.per_channel], time.time())
+        self.entries.move_to_end(channel_id)
+        while len(self.entries) > self.max_channels:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    async def refresh(self, channel_id, slots):
+        task = self.inflight.get(channel_id)
+        if task is None:
+            async def run():
+                try:
+                    async with slots:
+                        videos = await self.fetch(channel_id)
+                    self.merge(channel_id, videos)
+                finally:
+                    self.inflight.pop(channel_id, None)
+
+            task = self.inflight[channel_id] = asyncio.ensure_future(run())
+        await asyncio.shield(task)
+
+    async def collect(self, channel_ids, limit=100):
+        # 戻り値: (新しい順の動画, 取得できなかったチャンネル)
+        now = time.time()
+        stale = []
+        for channel_id in channel_ids:
+            entry = self.entries.get(channel_id)
+            if entry is not None and now - entry[1] < self.ttl:
+                self.hits += 1
+                self.entries.move_to_end(channel_id)
+            else:
+                self.misses += 1
+                stale.append(channel_id)
+
+        failed = []
+        if stale:
+            slots = asyncio.Semaphore(self.concurrency)
+            results = await asyncio.gather(
+                *(self.refresh(channel_id, slots) for channel_id in stale),
+                return_exceptions=True
+            )
+            for channel_id, result in zip(stale, results):
+                if isinstance(result, Exception):
+                    # 古い値があればそれを使う
+                    failed.append(channel_id)
+
+        videos = []
+        for channel_id in channel_ids:
+            entry = self.entries.get(channel_id)
+            if entry is not None:
+                videos.extend(entry[0])
+        videos.sort(key=lambda v: v.get("published") or 0, reverse=True)
+        return videos[:limit], failed
@@ -0,0 +1,197 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+import logging
+import os
+import threading
+import time
+import zlib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# =========================
+# 結合済み動画のディスクキャッシュ（yobi.py 用）
+# =========================
+#
+# ファイル名 -> (サイズ, 作成時刻) の索引をメモリに持ち、最後に使った順に並べる。
+# 容量（max_bytes）と寿命（ttl）を超えた分は裏のスレッドが古い順に消す。
+# リクエストごとに listdir はしない（他プロセスが作ったファイルは get 時と定期再走査で拾う）。
+#
+# lock(name) は同じファイルを作るのを1回に絞る。プロセス内はキーごとの Lock、
+# プロセス間は locks/ 以下のロックファイル（flock）。ロックファイルは名前のハッシュで
+# LOCK_STRIPES 個に振り分けるので増え続けない（まれに別キー同士が待ち合うだけ）。
+
+LOCK_STRIPES = 256
+PART_SUFFIX = ".part"
+
+
+class FileCache:
+    def __init__(self, directory, max_bytes, ttl=None, interval=60, rescan_interval=600, stale_part=3600):
+        self.directory = directory
+        self.lock_dir = os.path.join(directory, "locks")
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.interval = interval
+        self.rescan_interval = rescan_interval
+        self.stale_part = stale_part
+        self.entries = OrderedDict()  # name -> (size, created)
+        self.size = 0
+        self.mutex = threading.Lock()
+        self.key_locks = {}  # name -> [Lock, 参照数]
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(self.lock_dir, exist_ok=True)
+        self.scan()
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    # ---------- 索引 ----------
+
+    def scan(self):
+        # 起動時と定期的に1回だけ走査して索引を作り直す
+        now = time.time()
+        found = []
+        for entry in os.scandir(self.directory):
+            if not entry.is_file():
+                continue
+            st = entry.stat()
+            if entry.name.endswith(PART_SUFFIX):
+                # 落ちたプロセスの書きかけ
+                if now - st.st_mtime > self.stale_part:
+                    self.unlink(entry.name)
+                continue
+            found.append((st.st_atime, entry.name, st.st_size, st.st_mtime))
+        found.sort()
+        known = {name: (size, created) for _, name, size, created in found}
+        with self.mutex:
+            # 新しく見つけたものはアクセス時刻順で古い側に、既知のものは今の LRU 順のまま
+            entries = OrderedDict((name, known[name]) for _, name, _, _ in found if name not in self.entries)
+            for name in self.entries:
+                if name in known:
+                    entries[name] = known[name]
+            self.entries = entries
+            self.size = sum(size for size, _ in entries.values())
+
+    def get(self, name):
+        # 有効なキャッシュがあればパスを返す
+        path = self.path(name)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            with self.mutex:
+                self.discard(name)
+                self.misses += 1
+            return None
+        with self.mutex:
+            if self.ttl is not None and time.time() - st.st_mtime > self.ttl:
+                self.misses += 1
+                expired = True
+            else:
+                expired = False
+                if name not in self.entries:
+                    # 他のプロセスが作ったもの
+                    self.entries[name] = (st.st_size, st.st_mtime)
+                    self.size += st.st_size
+                self.entries.move_to_end(name)
+                self.hits += 1
+        if expired:
+            self.wakeup.set()
+            return None
+        return path
+
+    def add(self, name):
+        # 完成したファイルを索引に載せる
+        st = os.stat(self.path(name))
+        with self.mutex:
+            self.discard(name)
+            self.entries[name] = (st.st_size, st.st_mtime)
+            self.size += st.st_size
+            over = self.size > self.max_bytes
+        if over:
+            self.wakeup.set()
+
+    def discard(self, name):
+        # self.mutex を持った状態で呼ぶ
+        entry = self.entries.pop(name, None)
+        if entry is not None:
+            self.size -= entry[0]
+
+    def unlink(self, name):
+        try:
+            os.remove(self.path(name))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logging.warning(f"キャッシュ削除失敗: {name}: {e}")
+
+    # ---------- 追い出し ----------
+
+    def evict(self):
+        now = time.time()
+        victims = []
+        with self.mutex:
+            if self.ttl is not None:
+                for name, (size, created) in list(self.entries.items()):
+                    if now - created > self.ttl:
+                        self.discard(name)
+                        victims.append(name)
+            while self.size > self.max_bytes and self.entries:
+                name, (size, _) = self.entries.popitem(last=False)
+                self.size -= size
+                victims.append(name)
+            self.evictions += len(victims)
+        # 配信中のファイルを消しても、開いている分は最後まで読める
+        for name in victims:
+            logging.info(f"キャッシュ削除: {name}")
+            self.unlink(name)
+        return len(victims)
+
+    def run(self):
+        last_scan = time.monotonic()
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            try:
+                if time.monotonic() - last_scan > self.rescan_interval:
+                    self.scan()
+                    last_scan = time.monotonic()
+                self.evict()
+            except Exception as e:
+                logging.error(f"キャッシュ整理エラー: {e}")
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name="filecache-evict", daemon=True)
+            self.thread.start()
+
+    # ---------- 作成の排他 ----------
+
+    @contextmanager
+    def lock(self, name):
+        with self.mutex:
+            entry = self.key_locks.setdefault(name, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                if fcntl is None:
+                    yield
+                    return
+                stripe = zlib.crc32(name.encode()) % LOCK_STRIPES
+                with open(os.path.join(self.lock_dir, f"{stripe:02x}.lock"), "a") as f:
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                    try:
+                        yield
+                    finally:
+                        fcntl.flock(f, fcntl.LOCK_UN)
+        finally:
+            with self.mutex:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.key_locks[name]
@@ -1,22 +1,35 @@
 import json
 import urllib.parse
 import time
-import datetime
 import os
 import asyncio
-import base64
+import importlib.util
+import logging
+import re
+from contextlib import asynccontextmanager
 
+import metrics
 from cache import cache
+from dashmpd import build_mpd
+from diskstore import DiskStore
+from feed import ChannelFeed
+from pagecache import PageCache
+from staticassets import PrecompressedStaticFiles
+from upstream import InstancePool, Prober, UpstreamError, json_loads, race
+from videostore import VideoStore, stream_expiry
+from prefetch import Prefetcher
+from relay import StreamRelay
+from models import Channel, CommentPage, SearchChannel, SearchVideo, Video, search_item
+from nitter import decode_media_url, parse_x_tweets
 
 from fastapi import FastAPI, Request, Response, Cookie, HTTPException
-from fastapi.responses import HTMLResponse, RedirectResponse, Response as RawResponse
+from fastapi.responses import FileResponse, HTMLResponse, RedirectResponse, StreamingResponse, Response as RawResponse
 from fastapi.middleware.gzip import GZipMiddleware
-from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
+from starlette.background import BackgroundTask
 from starlette.exceptions import HTTPException as StarletteHTTPException
 from typing import Union
 import httpx
-from bs4 import BeautifulSoup
 
 # =========================
 # 基本設定
@@ -44,6 +57,10 @@ apis = [
     "https://yt.cdaut.de/",
 ]
 
+# ベンチ（bench/loadtest.py）などで差し替える時用。カンマ区切り
+if os.environ.get("INVIDIOUS_INSTANCES"):
+    apis = [u.strip().rstrip("/") + "/" for u in os.environ["INVIDIOUS_INSTANCES"].split(",") if u.strip()]
+
 apichannels = apis.copy()
 apicomments = apis.copy()
 
@@ -68,51 +85,154 @@ def check_cookie(cookie: Union[str, None]) -> bool:
     return cookie == "True"
 
 # =========================
-# 並列API最速勝ち
+# 共有HTTPクライアント（接続プール）
 # =========================
 
-async def api_request_core(api_list, url):
-    start = time.time()
-    lock = asyncio.Lock()
+def env_int(name, default):
+    try:
+        return int(os.environ.get(name, default))
+    except ValueError:
+        return default
 
-    async def fetch(client, api):
-        try:
-            r = await client.get(api + url, timeout=max_api_wait_time)
-            r.raise_for_status()
-            return api, r.text
-        except:
-            return None
+def env_float(name, default):
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+# h2 が入っていれば HTTP/2（ALPN で非対応の相手は自動で HTTP/1.1）
+HTTP2_ENABLED = importlib.util.find_spec("h2") is not None and os.environ.get("HTTP2", "1") != "0"
+HTTP_KEEPALIVE_EXPIRY = env_float("HTTP_KEEPALIVE_EXPIRY", 30)
+
+# 上流の種類ごと: (最大接続数, keep-alive保持数, タイムアウト秒)
+# 環境変数 HTTP_<種類>_MAX_CONNECTIONS / HTTP_<種類>_MAX_KEEPALIVE で上書き可
+HTTP_CLIENT_CONFIG = {
+    "api":   (100, 40, max_api_wait_time),  # Invidious
+    "x":     (20, 10, max_api_wait_time),   # Nitter
+    "img":   (50, 20, 5),                   # img.youtube.com
+    "media": (30, 10, 5),                   # Nitter 画像・動画
+}
+
+http_clients = {}
+
+def build_client(kind):
+    max_conn, max_keepalive, timeout = HTTP_CLIENT_CONFIG[kind]
+    name = kind.upper()
+    return httpx.AsyncClient(
+        headers={"User-Agent": "Mozilla/5.0"},
+        timeout=timeout,
+        http2=HTTP2_ENABLED,
+        limits=httpx.Limits(
+            max_connections=env_int(f"HTTP_{name}_MAX_CONNECTIONS", max_conn),
+            max_keepalive_connections=env_int(f"HTTP_{name}_MAX_KEEPALIVE", max_keepalive),
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        ),
+    )
 
-    async with httpx.AsyncClient(headers={"User-Agent": "Mozilla/5.0"}) as client:
-        tasks = [fetch(client, api) for api in api_list[:8]]
-        for fut in asyncio.as_completed(tasks, timeout=max_time):
-            try:
-                result = await fut
-            except asyncio.TimeoutError:
-                continue
-            if not result:
-                continue
-            api, text = result
-            try:
-                json.loads(text)
-            except:
-                continue
-            async with lock:
-                if api in api_list:
-                    api_list.remove(api)
-                    api_list.insert(0, api)
-            return text
+def get_client(kind) -> httpx.AsyncClient:
+    # 通常は lifespan で作成済み。lifespan 外から呼ばれた場合だけ遅延生成
+    client = http_clients.get(kind)
+    if client is None or client.is_closed:
+        client = http_clients[kind] = build_client(kind)
+    return client
+
+async def close_clients():
+    clients = list(http_clients.values())
+    http_clients.clear()
+    await asyncio.gather(*(c.aclose() for c in clients), return_exceptions=True)
+
+@asynccontextmanager
+async def lifespan(app):
+    for kind in HTTP_CLIENT_CONFIG:
+        get_client(kind)
+    if os.environ.get("PROBE", "1") != "0":
+        prober.start()
+    background = []
+    if os.environ.get("BACKGROUND_REFRESH", "1") != "0":
+        background.append(asyncio.ensure_future(refresh_home_loop()))
+        prefetcher.start()
+    try:
+        yield
+    finally:
+        for task in background:
+            task.cancel()
+        await asyncio.gather(*background, return_exceptions=True)
+        await prefetcher.stop()
+        await prober.stop()
+        await close_clients()
 
-    raise APItimeoutError("API timeout")
+# =========================
+# ヘッジ付き並列API
+# =========================
+
+# プールごと: (同時に投げる最大数, ヘッジ遅延秒 None=p90から自動)
+# 環境変数 HEDGE_<名前>_WIDTH / HEDGE_<名前>_DELAY で上書き可
+HEDGE_CONFIG = {
+    "apis":        (2, None),
+    "apichannels": (2, None),
+    "apicomments": (3, None),
+}
+
+def build_pool(name, instances):
+    width, delay = HEDGE_CONFIG[name]
+    key = name.upper()
+    if os.environ.get(f"HEDGE_{key}_DELAY"):
+        delay = env_float(f"HEDGE_{key}_DELAY", delay)
+    return InstancePool(
+        name,
+        instances,
+        width=env_int(f"HEDGE_{key}_WIDTH", width),
+        hedge_delay=delay,
+        max_delay=max_api_wait_time,
+    )
+
+api_pools = {
+    "apis": build_pool("apis", apis),
+    "apichannels": build_pool("apichannels", apichannels),
+    "apicomments": build_pool("apicomments", apicomments),
+}
+
+# プールごとにヘルスチェックする機能
+PROBE_TARGETS = {
+    "apis": ("search", "videos", "popular"),
+    "apichannels": ("channels",),
+    "apicomments": ("comments",),
+}
+
+prober = Prober(
+    [(api_pools[name], cap) for name, caps in PROBE_TARGETS.items() for cap in caps],
+    lambda: get_client("api"),
+    interval=env_int("PROBE_INTERVAL", 120),
+    path=os.environ.get("SCOREBOARD_PATH", "scoreboard.json"),
+)
+
+def capability_of(url):
+    # "api/v1/search?q=..." -> "search"
+    parts = url.split("?", 1)[0].split("/")
+    return parts[2] if len(parts) > 2 else None
+
+async def api_request_core(pool, url):
+    client = get_client("api")
+
+    async def fetch(api):
+        r = await client.get(api + url, timeout=max_api_wait_time)
+        r.raise_for_status()
+        # 検証を兼ねてここで1回だけデコードし、呼び出し側には dict/list を返す
+        return json_loads(r.content)
+
+    try:
+        return await race(pool, fetch, timeout=max_time, capability=capability_of(url))
+    except UpstreamError:
+        raise APItimeoutError("API timeout")
 
 async def apirequest(url):
-    return await api_request_core(apis, url)
+    return await api_request_core(api_pools["apis"], url)
 
 async def apichannelrequest(url):
-    return await api_request_core(apichannels, url)
+    return await api_request_core(api_pools["apichannels"], url)
 
 async def apicommentsrequest(url):
-    return await api_request_core(apicomments, url)
+    return await api_request_core(api_pools["apicomments"], url)
 
 # =========================
 # APIラッパー
@@ -120,131 +240,42 @@ async def apicommentsrequest(url):
 
 @cache(seconds=30)
 async def get_search(q, page):
-    data = json.loads(
-        await apirequest(f"api/v1/search?q={urllib.parse.quote(q)}&page={page}&hl=jp")
-    )
+    data = await apirequest(f"api/v1/search?q={urllib.parse.quote(q)}&page={page}&hl=jp")
+    return [search_item(i) for i in data]
 
-    results = []
-    for i in data:
-        t = i.get("type")
-        if t == "video":
-            results.append({
-                "type": "video",
-                "title": i["title"],
-                "id": i["videoId"],
-                "author": i["author"],
-                "authorId": i["authorId"],
-                "length": str(datetime.timedelta(seconds=i["lengthSeconds"])),
-                "published": i["publishedText"]
-            })
-        elif t == "playlist":
-            results.append({
-                "type": "playlist",
-                "title": i["title"],
-                "id": i["playlistId"],
-                "count": i["videoCount"]
-            })
-        else:
-            thumb = i["authorThumbnails"][-1]["url"]
-            if not thumb.startswith("https"):
-                thumb = "https://" + thumb
-            results.append({
-                "type": "channel",
-                "author": i["author"],
-                "id": i["authorId"],
-                "thumbnail": thumb
-            })
-    return results
-
-# =========================
-# ★ DASH対応
-# =========================
-
-async def get_data(videoid):
-    t = json.loads(await apirequest("api/v1/videos/" + urllib.parse.quote(videoid)))
-
-    videourls = [i["url"] for i in t.get("formatStreams", [])]
-    hls_url = t.get("hlsUrl")
-    nocookie_url = f"https://www.youtube-nocookie.com/embed/{videoid}"
-
-    adaptive = t.get("adaptiveFormats", [])
-
-    audio = None
-    videos = {}
-
-    for f in adaptive:
-        mime = f.get("type", "")
-        if mime.startswith("audio/"):
-            if not audio or f.get("bitrate", 0) > audio.get("bitrate", 0):
-                audio = f
-        elif mime.startswith("video/"):
-            h = f.get("height")
-            if h and (h not in videos or "mp4" in mime):
-                videos[h] = f
-
-    dash = None
-    if audio and videos:
-        dash = {
-            "audio": {
-                "url": audio["url"],
-                "mime": audio["type"],
-                "bitrate": audio.get("bitrate")
-            },
-            "videos": {
-                str(h): {
-                    "url": videos[h]["url"],
-                    "mime": videos[h]["type"],
-                    "fps": videos[h].get("fps"),
-                    "bitrate": videos[h].get("bitrate")
-                }
-                for h in sorted(videos.keys(), reverse=True)
-            }
-        }
+# =========================
+# 動画メタデータ（/watch・/stream/high 共通）
+# =========================
 
-    return (
-        [{"id": i["videoId"], "title": i["title"], "author": i["author"], "authorId": i["authorId"]}
-         for i in t["recommendedVideos"]],
-        videourls,
-        t["descriptionHtml"].replace("\n", "<br>"),
-        t["title"],
-        t["authorId"],
-        t["author"],
-        t["authorThumbnails"][-1]["url"],
-        nocookie_url,
-        hls_url,
-        dash,
-        t
-    )
+async def fetch_video(videoid):
+    t = await apirequest("api/v1/videos/" + urllib.parse.quote(videoid))
+    return Video(t, expire=stream_expiry(t))
+
+video_store = VideoStore(
+    fetch_video,
+    max_entries=env_int("VIDEO_STORE_MAX_ENTRIES", 512),
+    expiry=lambda video: video.expire,
+)
+
+# /watch のあと関連動画の上位 N 件を先読み
+PREFETCH_TOP_N = env_int("PREFETCH_TOP_N", 3)
+
+prefetcher = Prefetcher(
+    video_store,
+    rate_per_minute=env_int("PREFETCH_PER_MINUTE", 30),
+    slow=max_api_wait_time / 2,
+)
+
+async def get_data(videoid) -> Video:
+    return await video_store.get(videoid)
 
 # =========================
 # ★ チャンネル
 # =========================
 
-async def get_channel(channelid):
-    t = json.loads(await apichannelrequest("api/v1/channels/" + urllib.parse.quote(channelid)))
-
-    videos = []
-    shorts = []
-
-    for i in t.get("latestVideos", []):
-        videos.append({
-            "title": i["title"],
-            "id": i["videoId"],
-            "view_count_text": i.get("viewCountText", ""),
-            "length_str": i.get("lengthText", "")
-        })
-
-    return (
-        videos,
-        shorts,
-        {
-            "channelname": t["author"],
-            "channelicon": t["authorThumbnails"][-1]["url"],
-            "channelprofile": t.get("description", ""),
-            "subscribers_count": t.get("subCountText"),
-            "cover_img_url": t["authorBanners"][-1]["url"] if t.get("authorBanners") else None
-        }
-    )
+@cache(seconds=300)
+async def get_channel(channelid) -> Channel:
+    return Channel(await apichannelrequest("api/v1/channels/" + urllib.parse.quote(channelid)))
 
 # =========================
 # ホーム
@@ -252,7 +283,7 @@ async def get_channel(channelid):
 
 @cache(seconds=30)
 async def get_home():
-    data = json.loads(await apirequest("api/v1/popular?hl=jp"))
+    data = await apirequest("api/v1/popular?hl=jp")
 
     videos = []
     shorts = []
@@ -261,34 +292,88 @@ async def get_home():
     for i in data:
         if i.get("type") == "video":
             if i.get("isShort") or not i.get("lengthSeconds"):
-                shorts.append(i)
+                shorts.append(SearchVideo(i))
             else:
-                videos.append(i)
+                videos.append(SearchVideo(i))
         elif i.get("type") == "channel":
-            channels.append(i)
+            channels.append(SearchChannel(i))
 
     return videos, shorts, channels
 
-async def get_comments(videoid):
-    t = json.loads(await apicommentsrequest("api/v1/comments/" + urllib.parse.quote(videoid) + "?hl=jp"))
-    return [{
-        "author": i["author"],
-        "authoricon": i["authorThumbnails"][-1]["url"],
-        "body": i["contentHtml"].replace("\n", "<br>")
-    } for i in t["comments"]]
+# 期限切れ前に popular を取り直し、最初の訪問者を待たせない
+HOME_REFRESH_MARGIN = 5
+
+async def refresh_home_loop():
+    while True:
+        try:
+            await get_home.refresh()
+            delay = max(get_home.ttl - HOME_REFRESH_MARGIN, 1)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.warning(f"home refresh failed: {e}")
+            delay = HOME_REFRESH_MARGIN
+        await asyncio.sleep(delay)
+
+# =========================
+# コメント（continuation でページ単位に取得・キャッシュ）
+# =========================
+
+@cache(seconds=300, max_size=512)
+async def get_comments(videoid, continuation=None) -> CommentPage:
+    url = "api/v1/comments/" + urllib.parse.quote(videoid) + "?hl=jp"
+    if continuation:
+        url += "&continuation=" + urllib.parse.quote(continuation)
+    return CommentPage(await apicommentsrequest(url))
+
+comment_prefetches = set()
+
+def prefetch_next_comments(videoid, page):
+    # 読んでいる間に次のページを温めておく
+    if not page.continuation:
+        return
+    task = asyncio.ensure_future(get_comments(videoid, page.continuation))
+    comment_prefetches.add(task)
+    task.add_done_callback(lambda t: (comment_prefetches.discard(t), t.cancelled() or t.exception()))
 
 # =========================
 # FastAPI
 # =========================
 
-app = FastAPI(docs_url=None, redoc_url=None, openapi_url=None)
+app = FastAPI(docs_url=None, redoc_url=None, openapi_url=None, lifespan=lifespan)
+
+css_files = PrecompressedStaticFiles(directory="./css")
+word_files = PrecompressedStaticFiles(directory="./blog", html=True)
+app.mount("/css", css_files, name="css")
+app.mount("/word", word_files, name="word")
+
+class SelectiveGZip:
+    # NDJSON のストリームは GZip を通さない（圧縮側に溜め込まれると行ごとに届かなくなる）
+    def __init__(self, app, minimum_size, skip_paths):
+        self.app = app
+        self.gzip = GZipMiddleware(app, minimum_size=minimum_size)
+        self.skip_paths = set(skip_paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] in self.skip_paths:
+            await self.app(scope, receive, send)
+            return
+        await self.gzip(scope, receive, send)
 
-app.mount("/css", StaticFiles(directory="./css"), name="css")
-app.mount("/word", StaticFiles(directory="./blog", html=True), name="word")
-app.add_middleware(GZipMiddleware, minimum_size=1000)
+app.add_middleware(SelectiveGZip, minimum_size=1000, skip_paths=("/api/batch/videos",))
+app.add_middleware(metrics.RouteMetrics)
 
 templates = Jinja2Templates(directory="templates")
 
+def static_url(path):
+    # テンプレート用: "/css/default.css" -> "/css/default.<hash>.css"
+    for prefix, files in (("/css/", css_files), ("/word/", word_files)):
+        if path.startswith(prefix):
+            return prefix + files.url(path[len(prefix):])
+    return path
+
+templates.env.globals["static_url"] = static_url
+
 # =========================
 # 高画質ストリーム
 # =========================
@@ -308,29 +393,115 @@ async def stream_high(v: str):
     except:
         pass
 
-    t = json.loads(await apirequest("api/v1/videos/" + urllib.parse.quote(v)))
-    if t.get("hlsUrl"):
-        return RedirectResponse(t["hlsUrl"])
+    video = await video_store.get(v)
+    if video.hls_url:
+        return RedirectResponse(video.hls_url)
 
     raise HTTPException(status_code=503, detail="High quality stream unavailable")
 
+# =========================
+# DASH マニフェスト（画質の自動切り替え用）
+# =========================
+
+@app.get("/manifest/dash/{video_id}.mpd")
+async def dash_manifest(video_id: str, relay: bool = False):
+    try:
+        video = await get_data(video_id)
+    except APItimeoutError:
+        raise HTTPException(status_code=503, detail="Video info unavailable")
+
+    relayed = relay and RELAY_ENABLED
+    mpd = build_mpd(video, url=(lambda f: f"/relay/{video.id}/{f.itag}") if relayed else None)
+    if mpd is None:
+        raise HTTPException(status_code=404, detail="No DASH formats")
+
+    # ストリームURLの expire を越えてキャッシュさせない（中継URLは期限なし）
+    max_age = 300
+    if video.expire and not relayed:
+        max_age = max(0, min(max_age, int(video.expire - time.time()) - video_store.margin))
+    return RawResponse(
+        mpd,
+        media_type="application/dash+xml",
+        headers={"Cache-Control": f"private, max-age={max_age}"}
+    )
+
+# =========================
+# googlevideo 中継（任意・RELAY=1 で有効）
+# =========================
+#
+# /relay/{video_id}/{itag} を Range 付きで返す。googlevideo に直接つながらない環境向け。
+# チャンク単位でメモリ/ディスクにキャッシュし、同じ動画を見ている人同士で上流への取得を共有する。
+# 誰でも使える中継になり、ディスク（既定 1GiB）とメモリ（既定 64MiB）も使うので既定では無効。
+
+RELAY_ENABLED = os.environ.get("RELAY", "0") == "1"
+
+async def resolve_stream(video_id, itag, refresh=False):
+    if refresh:
+        # 期限切れ・失効したURL。メタデータごと取り直す
+        video_store.invalidate(video_id)
+    try:
+        video = await get_data(video_id)
+    except APItimeoutError:
+        raise HTTPException(status_code=503, detail="Video info unavailable")
+    return video.find_stream(itag)
+
+if RELAY_ENABLED:
+    # 無効の時はディスクキャッシュのディレクトリも作らない
+    stream_relay = StreamRelay(
+        resolve_stream,
+        lambda: get_client("media"),
+        DiskStore(
+            os.environ.get("RELAY_CACHE_DIR", "cache/relay"),
+            max_bytes=env_int("RELAY_DISK_BYTES", 1024 * 1024 * 1024),
+        ),
+        max_memory=env_int("RELAY_MEMORY_BYTES", 64 * 1024 * 1024),
+        chunk_size=env_int("RELAY_CHUNK_BYTES", 1024 * 1024),
+        readahead=env_int("RELAY_READAHEAD", 2),
+    )
+
+    @app.get("/relay/{video_id}/{itag}")
+    async def relay_stream(request: Request, video_id: str, itag: str):
+        return await stream_relay.respond(request, video_id, itag)
+
+# =========================
+# 描画済みページキャッシュ（/・/search・/channel）
+# =========================
+
+page_cache = PageCache(max_entries=env_int("PAGE_CACHE_MAX_ENTRIES", 256))
+
+def render_cached(request, key, source, name, context):
+    # source（@cache の戻り値）が同じ間は描画も圧縮もやり直さない
+    page = page_cache.get(key, source)
+    if page is None:
+        html = templates.get_template(name).render({"request": request, **context})
+        page = page_cache.put(key, source, html)
+
+    body, encoding = page.select(request.headers.get("accept-encoding"))
+    headers = {"Vary": "Accept-Encoding"}
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    response = HTMLResponse(content=body, headers=headers)
+    response.set_cookie("sennin", "True", max_age=7 * 24 * 60 * 60)
+    return response
+
 # =========================
 # ルーティング
 # =========================
 
 @app.get("/", response_class=HTMLResponse)
-async def home(request: Request, response: Response, sennin: Union[str, None] = Cookie(None)):
+async def home(request: Request, sennin: Union[str, None] = Cookie(None)):
     if not check_cookie(sennin):
         return RedirectResponse("/word")
 
-    response.set_cookie("sennin", "True", max_age=7 * 24 * 60 * 60)
-
-    videos, shorts, channels = await get_home()
+    data = await get_home()
+    videos, shorts, channels = data
 
-    return templates.TemplateResponse(
+    return render_cached(
+        request,
+        ("home",),
+        data,
         "home.html",
         {
-            "request": request,
             "videos": videos,
             "shorts": shorts,
             "channels": channels,
@@ -338,15 +509,17 @@ async def home(request: Request, response: Response, sennin: Union[str, None] =
     )
 
 @app.get("/search", response_class=HTMLResponse)
-async def search(request: Request, response: Response, q: str, page: int = 1, sennin: Union[str, None] = Cookie(None)):
+async def search(request: Request, q: str, page: int = 1, sennin: Union[str, None] = Cookie(None)):
     if not check_cookie(sennin):
         return RedirectResponse("/")
-    response.set_cookie("sennin", "True", max_age=7 * 24 * 60 * 60)
-    return templates.TemplateResponse(
+    results = await get_search(q, page)
+    return render_cached(
+        request,
+        ("search", q, page),
+        results,
         "search.html",
         {
-            "request": request,
-            "results": await get_search(q, page),
+            "results": results,
             "word": q,
             "next": f"/search?q={q}&page={page+1}",
         }
@@ -358,20 +531,20 @@ async def watch(request: Request, response: Response, v: str, sennin: Union[str,
         return RedirectResponse("/")
     response.set_cookie("sennin", "True", max_age=7 * 24 * 60 * 60)
 
-    data = await get_data(v)
-    t = data[10]
+    video = await get_data(v)
+    prefetcher.schedule(r.id for r in video.recommended[:PREFETCH_TOP_N])
 
-    if t.get("isShort") is True:
+    if video.is_short:
         return templates.TemplateResponse(
             "shorts.html",
             {
                 "request": request,
                 "videoid": v,
-                "author": t["author"],
-                "authorid": t["authorId"],
-                "authoricon": t["authorThumbnails"][-1]["url"],
-                "title": t["title"],
-                "hls_url": t.get("hlsUrl"),
+                "author": video.author,
+                "authorid": video.author_id,
+                "authoricon": video.author_icon,
+                "title": video.title,
+                "hls_url": video.hls_url,
             }
         )
 
@@ -380,38 +553,40 @@ async def watch(request: Request, response: Response, v: str, sennin: Union[str,
         {
             "request": request,
             "videoid": v,
-            "videourls": data[1],
-            "res": data[0],
-            "description": data[2],
-            "videotitle": data[3],
-            "authorid": data[4],
-            "author": data[5],
-            "authoricon": data[6],
-            "nocookie_url": data[7],
-            "hls_url": data[8],
-            "dash": data[9],
+            "videourls": video.video_urls,
+            "res": video.recommended,
+            "description": video.description,
+            "videotitle": video.title,
+            "authorid": video.author_id,
+            "author": video.author,
+            "authoricon": video.author_icon,
+            "nocookie_url": video.nocookie_url,
+            "hls_url": video.hls_url,
+            "dash": video.dash,
         }
     )
 
 @app.get("/channel/{cid}", response_class=HTMLResponse)
-async def channel(request: Request, response: Response, cid: str, sennin: Union[str, None] = Cookie(None)):
+async def channel(request: Request, cid: str, sennin: Union[str, None] = Cookie(None)):
     if not check_cookie(sennin):
         return RedirectResponse("/")
-    response.set_cookie("sennin", "True", max_age=7 * 24 * 60 * 60)
 
-    videos, shorts, info = await get_channel(cid)
+    info = await get_channel(cid)
 
-    return templates.TemplateResponse(
+    return render_cached(
+        request,
+        ("channel", cid),
+        info,
         "channel.html",
         {
-            "request": request,
-            "results": videos,
-            "shorts": shorts,
-            "channelname": info["channelname"],
-            "channelicon": info["channelicon"],
-            "channelprofile": info["channelprofile"],
-            "subscribers_count": info["subscribers_count"],
-            "cover_img_url": info["cover_img_url"],
+            "results": info.videos,
+            "shorts": [],
+            "channelid": info.id,
+            "channelname": info.channelname,
+            "channelicon": info.channelicon,
+            "channelprofile": info.channelprofile,
+            "subscribers_count": info.subscribers_count,
+            "cover_img_url": info.cover_img_url,
         }
     )
 
@@ -426,20 +601,218 @@ async def subuscript(request: Request, sennin: Union[str, None] = Cookie(None)):
 
 @app.get("/comments", response_class=HTMLResponse)
 async def comments(request: Request, v: str):
+    page = await get_comments(v, None)
+    prefetch_next_comments(v, page)
     return templates.TemplateResponse(
         "comments.html",
-        {"request": request, "comments": await get_comments(v)}
+        {
+            "request": request,
+            "videoid": v,
+            "comments": page.comments,
+            "continuation": page.continuation,
+        }
     )
 
-@app.get("/thumbnail")
-async def thumbnail(v: str):
-    async with httpx.AsyncClient() as client:
-        r = await client.get(f"https://img.youtube.com/vi/{v}/0.jpg")
-    return RawResponse(
-        content=r.content,
-        media_type="image/jpeg"
+@app.get("/api/comments")
+async def comments_api(v: str, continuation: Union[str, None] = None):
+    page = await get_comments(v, continuation or None)
+    prefetch_next_comments(v, page)
+    return {
+        "comments": [c.to_dict() for c in page.comments],
+        "continuation": page.continuation,
+    }
+
+# =========================
+# 登録チャンネルの新着フィード
+# =========================
+
+FEED_MAX_CHANNELS = env_int("FEED_MAX_CHANNELS", 100)
+FEED_LIMIT = env_int("FEED_LIMIT", 100)
+CHANNEL_ID_RE = re.compile(r"^UC[A-Za-z0-9_-]{22}$")
+
+async def fetch_channel_feed(channelid):
+    info = await get_channel(channelid)
+    return [
+        {
+            "id": v.id,
+            "title": v.title,
+            "author": info.channelname,
+            "authorId": info.id or channelid,
+            "published": v.published,
+            "publishedText": v.published_text,
+            "lengthText": v.length_str,
+            "viewCountText": v.view_count_text,
+            "thumbnail": f"/thumbnail?v={v.id}",
+        }
+        for v in info.videos
+    ]
+
+channel_feed = ChannelFeed(
+    fetch_channel_feed,
+    ttl=env_int("FEED_CHANNEL_TTL", 600),
+    per_channel=env_int("FEED_PER_CHANNEL", 30),
+    concurrency=env_int("FEED_CONCURRENCY", 4),
+)
+
+@app.get("/feed")
+async def feed(c: str, limit: int = FEED_LIMIT):
+    # c: チャンネルIDをカンマ区切りで
+    wanted = list(dict.fromkeys(i.strip() for i in c.split(",") if i.strip()))
+    if len(wanted) > FEED_MAX_CHANNELS:
+        raise HTTPException(status_code=400, detail=f"too many channels (max {FEED_MAX_CHANNELS})")
+    valid = [i for i in wanted if CHANNEL_ID_RE.match(i)]
+    videos, failed = await channel_feed.collect(valid, max(1, min(limit, FEED_LIMIT)))
+    return {
+        "videos": videos,
+        "failed": failed + [i for i in wanted if not CHANNEL_ID_RE.match(i)],
+    }
+
+# =========================
+# 動画メタデータの一括取得（履歴・ウォッチリスト用）
+# =========================
+
+BATCH_MAX_IDS = env_int("BATCH_MAX_IDS", 50)
+BATCH_CONCURRENCY = env_int("BATCH_CONCURRENCY", 6)
+VIDEO_ID_RE = re.compile(r"^[A-Za-z0-9_-]{11}$")
+
+def video_summary(videoid, video):
+    return {
+        "id": videoid,
+        "title": video.title,
+        "author": video.author,
+        "authorId": video.author_id,
+        "lengthSeconds": video.length_seconds,
+        "thumbnail": f"/thumbnail?v={videoid}",
+    }
+
+async def resolve_videos(ids):
+    # キャッシュにあるものを先に返し、残りは同時 BATCH_CONCURRENCY 件まで取りに行って終わった順に返す
+    slots = asyncio.Semaphore(BATCH_CONCURRENCY)
+    misses = []
+    for videoid in ids:
+        video = video_store.peek(videoid)
+        if video is None:
+            misses.append(videoid)
+        else:
+            yield video_summary(videoid, video)
+
+    async def fetch(videoid):
+        async with slots:
+            try:
+                return video_summary(videoid, await get_data(videoid))
+            except Exception:
+                return {"id": videoid, "error": "unavailable"}
+
+    tasks = [asyncio.ensure_future(fetch(videoid)) for videoid in misses]
+    try:
+        for task in asyncio.as_completed(tasks):
+            yield await task
+    finally:
+        for task in tasks:
+            task.cancel()
+
+@app.get("/api/batch/videos")
+async def batch_videos(ids: str, format: str = "ndjson"):
+    wanted = list(dict.fromkeys(i.strip() for i in ids.split(",") if i.strip()))
+    if len(wanted) > BATCH_MAX_IDS:
+        raise HTTPException(status_code=400, detail=f"too many ids (max {BATCH_MAX_IDS})")
+    valid = [i for i in wanted if VIDEO_ID_RE.match(i)]
+    invalid = [{"id": i, "error": "invalid id"} for i in wanted if not VIDEO_ID_RE.match(i)]
+
+    if format == "json":
+        # まとめて返す（要求した順）
+        found = {row["id"]: row async for row in resolve_videos(valid)}
+        found.update((row["id"], row) for row in invalid)
+        return {"videos": [found[i] for i in wanted]}
+
+    async def rows():
+        for row in invalid:
+            yield json.dumps(row, ensure_ascii=False) + "\n"
+        async for row in resolve_videos(valid):
+            yield json.dumps(row, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(
+        rows(),
+        media_type="application/x-ndjson",
+        # 行ごとに順次届けたいので、このルートは SelectiveGZip で圧縮を外している
+        headers={"Cache-Control": "no-store"},
     )
 
+# =========================
+# メトリクス（Prometheus）
+# =========================
+
+metrics.REGISTRY.watch_cache("video_store", video_store)
+metrics.REGISTRY.watch_cache("page_cache", page_cache)
+metrics.REGISTRY.watch_cache("channel_feed", channel_feed)
+if RELAY_ENABLED:
+    metrics.REGISTRY.watch_cache("relay_memory", stream_relay.memory)
+    metrics.REGISTRY.watch_cache("relay_disk", stream_relay.disk)
+
+if metrics.endpoint_enabled():
+    @app.get("/metrics")
+    async def metrics_endpoint(request: Request, token: Union[str, None] = None):
+        if not metrics.authorized(request.headers.get("authorization"), token):
+            raise HTTPException(status_code=403)
+        return RawResponse(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+# =========================
+# サムネイル（ディスクキャッシュ + ETag）
+# =========================
+
+THUMBNAIL_CACHE_CONTROL = "public, max-age=604800"
+
+thumbnail_store = DiskStore(
+    os.environ.get("THUMBNAIL_CACHE_DIR", "cache/thumbnails"),
+    max_bytes=env_int("THUMBNAIL_CACHE_BYTES", 256 * 1024 * 1024),
+    ttl=7 * 24 * 60 * 60,
+)
+metrics.REGISTRY.watch_cache("thumbnails", thumbnail_store)
+
+# 見つからない動画は YouTube が返すプレースホルダー画像をそのまま返す（ディスクには保存しない）
+THUMBNAIL_PLACEHOLDER_CACHE_CONTROL = "public, max-age=3600"
+
+class ThumbnailUnavailable(Exception):
+    def __init__(self, body, media_type):
+        self.body = body
+        self.media_type = media_type
+
+async def thumbnail_chunks(v):
+    async with get_client("img").stream("GET", f"https://img.youtube.com/vi/{urllib.parse.quote(v)}/0.jpg") as r:
+        if r.status_code != 200:
+            raise ThumbnailUnavailable(await r.aread(), r.headers.get("content-type", "image/jpeg"))
+        async for chunk in r.aiter_bytes():
+            yield chunk
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*" or tag == etag or tag == "W/" + etag:
+            return True
+    return False
+
+@app.get("/thumbnail")
+async def thumbnail(request: Request, v: str):
+    try:
+        entry = await thumbnail_store.get_or_fetch(v, lambda: thumbnail_chunks(v))
+    except ThumbnailUnavailable as e:
+        return RawResponse(e.body, media_type=e.media_type, headers={"Cache-Control": THUMBNAIL_PLACEHOLDER_CACHE_CONTROL})
+    except httpx.HTTPError:
+        # 接続・読み込みのタイムアウトなど
+        raise HTTPException(status_code=502)
+    if entry is None:
+        raise HTTPException(status_code=502)
+    path, digest, size = entry
+
+    etag = f'"{digest}"'
+    headers = {"ETag": etag, "Cache-Control": THUMBNAIL_CACHE_CONTROL}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return RawResponse(status_code=304, headers=headers)
+
+    return FileResponse(path, media_type="image/jpeg", headers=headers)
+
 # ============================================================
 # ★★★ X (Nitter系) 統合・完全 async ★★★
 # ============================================================
@@ -450,57 +823,22 @@ X_INSTANCES = [
     "https://nuku.trabun.org",
 ]
 
+if os.environ.get("NITTER_INSTANCES"):
+    X_INSTANCES = [u.strip().rstrip("/") for u in os.environ["NITTER_INSTANCES"].split(",") if u.strip()]
+
 async def x_fetch(path: str):
-    async with httpx.AsyncClient(headers={"User-Agent": "Mozilla/5.0"}, timeout=max_api_wait_time) as client:
-        for base in X_INSTANCES:
-            try:
+    client = get_client("x")
+    endpoint = path.split("?", 1)[0].strip("/") or "root"
+    for base in X_INSTANCES:
+        try:
+            with metrics.outbound("x", base, endpoint):
                 r = await client.get(base + path, follow_redirects=True)
                 r.raise_for_status()
-                return r.text, base
-            except:
-                continue
-    raise APItimeoutError("X fetch failed")
-
-def encode_media_url(url: str) -> str:
-    return base64.urlsafe_b64encode(url.encode()).decode()
-
-def decode_media_url(data: str) -> str:
-    return base64.urlsafe_b64decode(data.encode()).decode()
-
-def parse_x_tweets(html: str, base: str):
-    soup = BeautifulSoup(html, "lxml")
-    tweets = []
-
-    for item in soup.select(".timeline-item"):
-        content = item.select_one(".tweet-content")
-        if not content:
+            return r.text, base
+        except:
             continue
-
-        text = content.get_text("\n", strip=True)
-
-        images = []
-        for img in item.select("a.still-image img"):
-            src = img.get("src")
-            if src:
-                if not src.startswith("http"):
-                    src = base + src
-                images.append("/x/media?u=" + encode_media_url(src))
-
-        videos = []
-        for v in item.select("video source"):
-            src = v.get("src")
-            if src:
-                if not src.startswith("http"):
-                    src = base + src
-                videos.append("/x/media?u=" + encode_media_url(src))
-
-        tweets.append({
-            "text": text,
-            "images": images,
-            "videos": videos,
-        })
-
-    return tweets
+    metrics.upstream_exhausted.inc("x", endpoint)
+    raise APItimeoutError("X fetch failed")
 
 @app.get("/api/x/search")
 @cache(seconds=60)
@@ -527,18 +865,85 @@ async def x_search_page(request: Request, q: str):
 # ★★★ X メディア完全プロキシ（localhost不可）★★★
 # ============================================================
 
+# 同時ストリーム数・1レスポンスあたりのサイズ/時間の上限
+X_MEDIA_MAX_STREAMS = env_int("X_MEDIA_MAX_STREAMS", 16)
+X_MEDIA_MAX_BYTES = env_int("X_MEDIA_MAX_BYTES", 32 * 1024 * 1024)
+X_MEDIA_MAX_SECONDS = env_float("X_MEDIA_MAX_SECONDS", 120)
+X_MEDIA_QUEUE_WAIT = 5
+
+X_MEDIA_REQUEST_HEADERS = ("range", "if-range", "if-none-match", "if-modified-since")
+X_MEDIA_RESPONSE_HEADERS = (
+    "content-type", "content-length", "content-range", "content-encoding",
+    "accept-ranges", "etag", "last-modified", "cache-control",
+)
+
+x_media_slots = asyncio.Semaphore(X_MEDIA_MAX_STREAMS)
+
+def clamp_range(value):
+    # "bytes=N-"（終端なし）を上限サイズまでに丸める。複数範囲などはそのまま
+    if not value or not value.startswith("bytes=") or "," in value:
+        return value
+    start, _, end = value[6:].strip().partition("-")
+    if not start.isdigit():
+        return value
+    last = int(start) + X_MEDIA_MAX_BYTES - 1
+    if end.isdigit():
+        last = min(last, int(end))
+    elif end:
+        return value
+    return f"bytes={start}-{last}"
+
 @app.get("/x/media")
-async def x_media_proxy(u: str):
+async def x_media_proxy(request: Request, u: str):
     url = decode_media_url(u)
 
     if not url.startswith("https://"):
         raise HTTPException(status_code=400)
 
-    async with httpx.AsyncClient(headers={"User-Agent": "Mozilla/5.0"}, timeout=5) as client:
-        r = await client.get(url)
-        r.raise_for_status()
+    try:
+        await asyncio.wait_for(x_media_slots.acquire(), X_MEDIA_QUEUE_WAIT)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=503)
+
+    headers = {k: request.headers[k] for k in X_MEDIA_REQUEST_HEADERS if k in request.headers}
+    if "range" in headers:
+        headers["range"] = clamp_range(headers["range"])
+
+    client = get_client("media")
+    released = False
 
-    return Response(
-        content=r.content,
-        media_type=r.headers.get("content-type", "application/octet-stream")
+    async def release():
+        nonlocal released
+        if not released:
+            released = True
+            x_media_slots.release()
+            await r.aclose()
+
+    try:
+        r = await client.send(client.build_request("GET", url, headers=headers), stream=True)
+    except:
+        x_media_slots.release()
+        raise HTTPException(status_code=502)
+
+    if r.status_code >= 400:
+        await release()
+        raise HTTPException(status_code=404 if r.status_code == 404 else 502)
+
+    async def body():
+        sent = 0
+        deadline = time.monotonic() + X_MEDIA_MAX_SECONDS
+        try:
+            async for chunk in r.aiter_raw():
+                sent += len(chunk)
+                if sent > X_MEDIA_MAX_BYTES or time.monotonic() > deadline:
+                    break
+                yield chunk
+        finally:
+            await release()
+
+    return StreamingResponse(
+        body(),
+        status_code=r.status_code,
+        headers={k: r.headers[k] for k in X_MEDIA_RESPONSE_HEADERS if k in r.headers},
+        background=BackgroundTask(release),
     )
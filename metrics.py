@@ -0,0 +1,304 @@
+from contextlib import contextmanager
+from threading import Lock
+import asyncio
+import bisect
+import logging
+import os
+import time
+
+from cache import cached_functions
+
+
+# =========================
+# Prometheus テキスト形式のメトリクス
+# =========================
+#
+# prometheus_client は使わず、必要な Counter / Gauge / Histogram だけを持つ（依存を増やさない）。
+# Flask（スレッド）からも asyncio からも使えるよう、値の更新は Lock で守る。
+# キャッシュ類は値を複製せず、/metrics を出す時に各オブジェクトの hits などを読みに行く。
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# 上流・ルートの所要時間（秒）
+LATENCY_BUCKETS = (0.025, 0.05, 0.1, 0.25, 0.5, 1, 2, 3, 5, 10, 30)
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{escape_label(v)}"' for k, v in pairs) + "}"
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = Lock()
+        self.values = {}  # ラベル値のタプル -> 値
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        with self.lock:
+            items = sorted(self.values.items())
+        return self.header() + [f"{self.name}{format_labels(self.labels, k)} {format_value(v)}" for k, v in items]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def set(self, *labels, value):
+        with self.lock:
+            self.values[labels] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        with self.lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                # [バケットごとの件数..., 合計, 件数]
+                entry = self.values[labels] = [0] * len(self.buckets) + [0.0, 0]
+            i = bisect.bisect_left(self.buckets, value)
+            if i < len(self.buckets):
+                entry[i] += 1
+            entry[-2] += value
+            entry[-1] += 1
+
+    def render(self):
+        with self.lock:
+            items = sorted((k, list(v)) for k, v in self.values.items())
+        lines = self.header()
+        for k, entry in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets, entry):
+                cumulative += n
+                lines.append(f"{self.name}_bucket{format_labels(self.labels, k, [('le', format_value(float(bound)))])} {cumulative}")
+            lines.append(f"{self.name}_bucket{format_labels(self.labels, k, [('le', '+Inf')])} {entry[-1]}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, k)} {format_value(entry[-2])}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, k)} {entry[-1]}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.caches = []  # (名前, オブジェクト)
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.add(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self.add(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self.add(Histogram(name, help, labels, buckets))
+
+    def watch_cache(self, name, obj):
+        # hits / misses / evictions（あれば coalesced も）を持つオブジェクト（VideoStore, DiskStore, FileCache など）
+        self.caches.append((name, obj))
+
+    def cache_samples(self):
+        # -> {メトリクス名: [(キャッシュ名, 値), ...]}
+        samples = {"hits": [], "misses": [], "coalesced": [], "evictions": [], "entries": [], "bytes": []}
+        for f in cached_functions:
+            info = f.cache_info()
+            name = f.__qualname__
+            samples["hits"].append((name, info.hits))
+            samples["misses"].append((name, info.misses))
+            samples["coalesced"].append((name, info.coalesced))
+            samples["evictions"].append((name, info.evictions))
+            samples["entries"].append((name, info.currsize))
+        for name, obj in self.caches:
+            for attr in ("hits", "misses", "coalesced", "evictions"):
+                if hasattr(obj, attr):
+                    samples[attr].append((name, getattr(obj, attr)))
+            entries = getattr(obj, "entries", None)
+            if entries is None:
+                entries = getattr(obj, "index", None)
+            if entries is not None:
+                samples["entries"].append((name, len(entries)))
+            if isinstance(getattr(obj, "size", None), int):
+                samples["bytes"].append((name, obj.size))
+        return samples
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        kinds = {
+            "hits": ("counter", "Cache hits"),
+            "misses": ("counter", "Cache misses"),
+            "coalesced": ("counter", "Lookups that joined a fetch already in flight"),
+            "evictions": ("counter", "Entries evicted from the cache"),
+            "entries": ("gauge", "Entries currently held"),
+            "bytes": ("gauge", "Bytes currently held"),
+        }
+        for key, values in self.cache_samples().items():
+            kind, help = kinds[key]
+            name = f"cache_{key}_total" if kind == "counter" else f"cache_{key}"
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for cache_name, value in values:
+                lines.append(f"{name}{format_labels(('cache',), (cache_name,))} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# ---------- 上流 ----------
+
+upstream_latency = REGISTRY.histogram(
+    "upstream_request_seconds", "Outbound request latency per instance and endpoint",
+    ("pool", "instance", "endpoint", "outcome"),
+)
+upstream_errors = REGISTRY.counter(
+    "upstream_errors_total", "Failed outbound requests per instance and endpoint",
+    ("pool", "instance", "endpoint", "error"),
+)
+upstream_inflight = REGISTRY.gauge(
+    "upstream_inflight_requests", "Outbound requests currently in flight", ("pool",),
+)
+upstream_exhausted = REGISTRY.counter(
+    "upstream_exhausted_total", "Calls where every instance failed or timed out", ("pool", "endpoint"),
+)
+
+# ---------- ルート ----------
+
+route_latency = REGISTRY.histogram(
+    "http_request_seconds", "Request latency per route", ("method", "route", "status"),
+)
+route_inflight = REGISTRY.gauge("http_inflight_requests", "Requests currently being handled")
+
+
+def error_name(e):
+    # HTTP のステータスエラーは "http_503" のようにまとめる
+    response = getattr(e, "response", None)
+    status = getattr(response, "status_code", None)
+    if status is not None:
+        return f"http_{status}"
+    return type(e).__name__
+
+
+@contextmanager
+def outbound(pool, instance, endpoint):
+    # with outbound("apis", api, "videos"): ... で所要時間・失敗・同時数を記録（async の中でも使える）
+    upstream_inflight.inc(pool)
+    start = time.monotonic()
+    outcome = "error"
+    try:
+        yield
+        outcome = "ok"
+    except asyncio.CancelledError:
+        # ヘッジで負けた側のキャンセルは失敗に数えない
+        outcome = "cancelled"
+        raise
+    except Exception as e:
+        upstream_errors.inc(pool, instance, endpoint, error_name(e))
+        raise
+    finally:
+        upstream_inflight.dec(pool)
+        upstream_latency.observe(time.monotonic() - start, pool, instance, endpoint, outcome)
+
+
+def observe_route(method, route, status, seconds):
+    route_latency.observe(seconds, method, route, str(status))
+
+
+def route_name(scope):
+    # ラベルが増えすぎないよう実際のURLではなくルートの定義（"/channel/{cid}" など）を使う
+    route = scope.get("route")
+    return getattr(route, "path", None) or "unmatched"
+
+
+class RouteMetrics:
+    # ASGI ミドルウェア（FastAPI 用）
+    # 所要時間はレスポンスヘッダーを返すまで（動画などのストリームの長さは含めない）
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.monotonic()
+        started = False
+
+        async def send_with_metrics(message):
+            nonlocal started
+            if message["type"] == "http.response.start" and not started:
+                started = True
+                observe_route(scope["method"], route_name(scope), message["status"], time.monotonic() - start)
+            await send(message)
+
+        route_inflight.inc()
+        try:
+            await self.app(scope, receive, send_with_metrics)
+        except Exception:
+            if not started:
+                observe_route(scope["method"], route_name(scope), 500, time.monotonic() - start)
+            raise
+        finally:
+            route_inflight.dec()
+
+
+def endpoint_enabled():
+    # /metrics は METRICS_TOKEN を設定するか METRICS_PUBLIC=1 の時だけ出す（既定では無効）
+    # 起動時に1回呼ぶ
+    if os.environ.get("METRICS_TOKEN"):
+        return True
+    if os.environ.get("METRICS_PUBLIC", "0") == "1":
+        logging.warning("/metrics is public (METRICS_PUBLIC=1 without METRICS_TOKEN)")
+        return True
+    logging.info("/metrics is disabled; set METRICS_TOKEN or METRICS_PUBLIC=1 to enable it")
+    return False
+
+
+def authorized(header, token):
+    # METRICS_TOKEN を設定した時は "Authorization: Bearer <token>" か ?token= を要求する
+    expected = os.environ.get("METRICS_TOKEN")
+    if not expected:
+        return True
+    return header == f"Bearer {expected}" or token == expected
+
+
+def render():
+    return REGISTRY.render()
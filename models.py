@@ -0,0 +1,248 @@
+import datetime
+import re
+
+
+# =========================
+# 上流JSONから作る軽量モデル
+# =========================
+#
+# テンプレートで使う項目だけを __slots__ で持つ（キャッシュ1件あたりのメモリ削減）。
+# 属性名はテンプレート側の名前に合わせている。
+
+ITAG_RE = re.compile(r"[?&]itag=(\d+)")
+
+
+def last_url(thumbs):
+    return thumbs[-1]["url"] if thumbs else None
+
+
+class SearchVideo:
+    __slots__ = ("id", "title", "author", "authorId", "length", "published", "view_count_text")
+    type = "video"
+
+    def __init__(self, i):
+        self.id = i["videoId"]
+        self.title = i["title"]
+        self.author = i["author"]
+        self.authorId = i["authorId"]
+        self.length = str(datetime.timedelta(seconds=i.get("lengthSeconds") or 0))
+        self.published = i.get("publishedText", "")
+        self.view_count_text = i.get("viewCountText", "")
+
+
+class SearchPlaylist:
+    __slots__ = ("id", "title", "count", "thumbnail")
+    type = "playlist"
+
+    def __init__(self, i):
+        self.id = i["playlistId"]
+        self.title = i["title"]
+        self.count = i["videoCount"]
+        self.thumbnail = i.get("playlistThumbnail")
+
+
+class SearchChannel:
+    __slots__ = ("id", "author", "thumbnail")
+    type = "channel"
+
+    def __init__(self, i):
+        thumb = last_url(i["authorThumbnails"])
+        if thumb and not thumb.startswith("https"):
+            thumb = "https://" + thumb.lstrip("/")
+        self.id = i["authorId"]
+        self.author = i["author"]
+        self.thumbnail = thumb
+
+
+def search_item(i):
+    t = i.get("type")
+    if t == "video":
+        return SearchVideo(i)
+    if t == "playlist":
+        return SearchPlaylist(i)
+    return SearchChannel(i)
+
+
+class RelatedVideo:
+    __slots__ = ("id", "title", "author")
+
+    def __init__(self, i):
+        self.id = i["videoId"]
+        self.title = i["title"]
+        self.author = i["author"]
+
+
+def byte_range(f, name):
+    # Invidious: "init": "0-740" / YouTube: "initRange": {"start": "0", "end": "740"}
+    r = f.get(name + "Range")
+    if isinstance(r, dict) and r.get("end") is not None:
+        return f"{r.get('start', 0)}-{r['end']}"
+    r = f.get(name)
+    return r if isinstance(r, str) and "-" in r else None
+
+
+class Format:
+    __slots__ = (
+        "url", "mime", "bitrate", "height", "fps",
+        "itag", "width", "init_range", "index_range", "sample_rate", "channels", "default_audio",
+    )
+
+    def __init__(self, f):
+        self.url = f["url"]
+        self.mime = f.get("type", "")
+        self.bitrate = int(f.get("bitrate") or 0)
+        # width/height が無い応答は size（"1920x1080"）から
+        w, _, h = (f.get("size") or "").partition("x")
+        self.height = f.get("height") or (int(h) if h.isdigit() else None)
+        self.fps = f.get("fps")
+        self.itag = str(f.get("itag") or "")
+        self.width = f.get("width") or (int(w) if w.isdigit() else None)
+        self.init_range = byte_range(f, "init")
+        self.index_range = byte_range(f, "index")
+        self.sample_rate = f.get("audioSampleRate")
+        self.channels = f.get("audioChannels")
+        track = f.get("audioTrack")
+        self.default_audio = not isinstance(track, dict) or track.get("audioIsDefault", True) is not False
+
+    @property
+    def container(self):
+        # 'video/mp4; codecs="avc1.640028"' -> "video/mp4"
+        return self.mime.split(";", 1)[0].strip()
+
+    @property
+    def codecs(self):
+        _, _, params = self.mime.partition("codecs=")
+        return params.strip().strip('"') or None
+
+
+class Video:
+    __slots__ = (
+        "id", "title", "author", "author_id", "author_icon", "description",
+        "video_urls", "hls_url", "is_short", "audio", "videos", "recommended", "expire",
+        "length_seconds", "segmented",
+    )
+
+    def __init__(self, t, expire=None):
+        self.id = t["videoId"]
+        self.title = t["title"]
+        self.author = t["author"]
+        self.author_id = t["authorId"]
+        self.author_icon = last_url(t["authorThumbnails"])
+        self.description = t["descriptionHtml"].replace("\n", "<br>")
+        self.video_urls = [i["url"] for i in t.get("formatStreams", [])]
+        self.hls_url = t.get("hlsUrl")
+        self.is_short = t.get("isShort") is True
+        self.recommended = [RelatedVideo(i) for i in t.get("recommendedVideos", [])]
+        self.expire = expire
+        self.length_seconds = t.get("lengthSeconds") or 0
+
+        # 最高ビットレートの音声と、高さごとの映像（mp4優先）
+        # segmented は DASH（SegmentBase）に使える init/index 付きのもの全部
+        audio = None
+        videos = {}
+        segmented = []
+        for f in t.get("adaptiveFormats", []):
+            if not f.get("url"):
+                continue
+            fmt = Format(f)
+            if fmt.init_range and fmt.index_range:
+                segmented.append(fmt)
+            mime = fmt.mime
+            if mime.startswith("audio/"):
+                if not audio or fmt.bitrate > audio.bitrate:
+                    audio = fmt
+            elif mime.startswith("video/"):
+                h = fmt.height
+                if h and (h not in videos or "mp4" in mime):
+                    videos[h] = fmt
+        self.audio = audio
+        self.videos = [videos[h] for h in sorted(videos, reverse=True)]
+        self.segmented = segmented
+
+    def find_stream(self, itag):
+        # itag -> (URL, mime)。無ければ None
+        itag = str(itag)
+        for f in self.segmented + self.videos + ([self.audio] if self.audio else []):
+            if f.itag == itag:
+                return f.url, f.container
+        for url in self.video_urls:
+            m = ITAG_RE.search(url)
+            if m and m.group(1) == itag:
+                return url, "video/mp4"
+        return None
+
+    @property
+    def nocookie_url(self):
+        return f"https://www.youtube-nocookie.com/embed/{self.id}"
+
+    @property
+    def dash(self):
+        if not self.audio or not self.videos:
+            return None
+        return {
+            "audio": {
+                "url": self.audio.url,
+                "mime": self.audio.mime,
+                "bitrate": self.audio.bitrate
+            },
+            "videos": {
+                str(v.height): {
+                    "url": v.url,
+                    "mime": v.mime,
+                    "fps": v.fps,
+                    "bitrate": v.bitrate
+                }
+                for v in self.videos
+            }
+        }
+
+
+class ChannelVideo:
+    __slots__ = ("id", "title", "view_count_text", "length_str", "published", "published_text")
+
+    def __init__(self, i):
+        self.id = i["videoId"]
+        self.title = i["title"]
+        self.view_count_text = i.get("viewCountText", "")
+        self.length_str = i.get("lengthText", "")
+        self.published = i.get("published") or 0
+        self.published_text = i.get("publishedText", "")
+
+
+class Channel:
+    __slots__ = ("id", "channelname", "channelicon", "channelprofile", "subscribers_count", "cover_img_url", "videos")
+
+    def __init__(self, t):
+        self.id = t.get("authorId")
+        self.channelname = t["author"]
+        self.channelicon = last_url(t["authorThumbnails"])
+        self.channelprofile = t.get("description", "")
+        self.subscribers_count = t.get("subCountText")
+        self.cover_img_url = last_url(t.get("authorBanners"))
+        self.videos = [ChannelVideo(i) for i in t.get("latestVideos", [])]
+
+
+class Comment:
+    __slots__ = ("author", "authorid", "authoricon", "body")
+
+    def __init__(self, i):
+        self.author = i["author"]
+        self.authorid = i.get("authorId")
+        self.authoricon = last_url(i["authorThumbnails"])
+        self.body = i["contentHtml"].replace("\n", "<br>")
+
+    def to_dict(self):
+        return {
+            "author": self.author,
+            "authorid": self.authorid,
+            "authoricon": self.authoricon,
+            "body": self.body,
+        }
+
+
+class CommentPage:
+    __slots__ = ("comments", "continuation")
+
+    def __init__(self, t):
+        self.comments = [Comment(i) for i in t.get("comments", [])]
+        self.continuation = t.get("continuation")
@@ -0,0 +1,222 @@
+import asyncio
+import logging
+import os
+import shutil
+import uuid
+
+
+# =========================
+# ffmpeg 結合ジョブのキュー（上限付き）
+# =========================
+#
+# 同じキー（video_id, quality）のジョブは1つだけ作り、後から来たリクエストも同じ出力を読む。
+# 出力は断片化MP4で一時ファイルに書き、クライアントには書けた所から順に流す。
+#
+# workers: 同時に動かす ffmpeg の数 / max_queue: 待たせておけるジョブ数（超えたら QueueFull）
+# idle: 読む人がいなくなってから ffmpeg を止めるまでの秒数
+# linger: 完成後に読む人がいなくなってからファイルを消すまでの秒数
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+
+class QueueFull(Exception):
+    pass
+
+
+def remove_orphans(base):
+    # 落ちたプロセスが残したディレクトリ（PID がもう動いていないもの）だけ消す
+    try:
+        names = os.listdir(base)
+    except FileNotFoundError:
+        return
+    for name in names:
+        if not name.isdigit():
+            continue
+        try:
+            os.kill(int(name), 0)
+        except ProcessLookupError:
+            shutil.rmtree(os.path.join(base, name), ignore_errors=True)
+        except PermissionError:
+            # 別ユーザーのプロセスが使っている
+            pass
+
+
+class MuxJob:
+    def __init__(self, key, command, path):
+        self.key = key
+        self.command = command  # 出力パス -> ffmpeg の引数
+        self.path = path
+        self.state = QUEUED
+        self.proc = None
+        self.readers = 0
+        self.cancelled = False
+        self.reap_handle = None
+        self.started = asyncio.Event()
+        self.finished = asyncio.Event()
+
+
+class MuxQueue:
+    def __init__(self, directory, workers=2, max_queue=8, idle=15, linger=60, poll=0.1):
+        self.base = directory
+        self.directory = None  # start() で決まる
+        self.workers = workers
+        self.max_queue = max_queue
+        self.idle = idle
+        self.linger = linger
+        self.poll = poll
+        self.jobs = {}
+        self.queue = None
+        self.tasks = []
+        self.started = 0
+        self.deduped = 0
+        self.rejected = 0
+        self.failed = 0
+
+    def start(self):
+        # base を複数のワーカープロセスで共有しても互いの出力を消さないよう、プロセスごとに分ける。
+        # fork 後（lifespan の中）で決めるので PID はワーカー自身のもの
+        self.directory = os.path.join(self.base, str(os.getpid()))
+        remove_orphans(self.base)
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.makedirs(self.directory, exist_ok=True)
+        self.queue = asyncio.Queue(self.max_queue)
+        self.tasks = [asyncio.ensure_future(self.worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        for job in list(self.jobs.values()):
+            self.reap(job, force=True)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    # ---------- 投入 ----------
+
+    def submit(self, key, command):
+        job = self.jobs.get(key)
+        if job is not None:
+            self.deduped += 1
+            self.keep(job)
+            return job
+        job = MuxJob(key, command, os.path.join(self.directory, f"{uuid.uuid4().hex}.mp4"))
+        try:
+            self.queue.put_nowait(job)
+        except asyncio.QueueFull:
+            self.rejected += 1
+            raise QueueFull(key)
+        self.jobs[key] = job
+        return job
+
+    async def worker(self):
+        while True:
+            job = await self.queue.get()
+            try:
+                if not job.cancelled:
+                    await self.run(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"mux job error {job.key}: {e}")
+                self.finish(job, FAILED)
+            finally:
+                self.queue.task_done()
+
+    async def run(self, job):
+        self.started += 1
+        open(job.path, "wb").close()
+        job.proc = await asyncio.create_subprocess_exec(
+            *job.command(job.path),
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+        job.state = RUNNING
+        job.started.set()
+        try:
+            code = await job.proc.wait()
+        except asyncio.CancelledError:
+            job.proc.kill()
+            raise
+        self.finish(job, DONE if code == 0 and not job.cancelled else FAILED)
+
+    def finish(self, job, state):
+        job.state = state
+        job.started.set()
+        job.finished.set()
+        if state == FAILED:
+            self.failed += 1
+            # 次のリクエストで作り直せるようにすぐ外す
+            if self.jobs.get(job.key) is job:
+                del self.jobs[job.key]
+        if job.readers == 0:
+            self.schedule_reap(job, 0 if state == FAILED else self.linger)
+
+    # ---------- 後片付け ----------
+
+    def keep(self, job):
+        if job.reap_handle is not None:
+            job.reap_handle.cancel()
+            job.reap_handle = None
+
+    def schedule_reap(self, job, delay):
+        self.keep(job)
+        job.reap_handle = asyncio.get_running_loop().call_later(delay, self.reap, job)
+
+    def reap(self, job, force=False):
+        job.reap_handle = None
+        if job.readers and not force:
+            return
+        job.cancelled = True
+        if job.proc is not None and job.proc.returncode is None:
+            job.proc.kill()
+        if self.jobs.get(job.key) is job:
+            del self.jobs[job.key]
+        try:
+            os.remove(job.path)
+        except FileNotFoundError:
+            pass
+
+    # ---------- 読み出し ----------
+
+    async def wait_output(self, job):
+        # 最初の出力が出るか終わるまで待つ。失敗なら False
+        # 待っている間も読む人として数え、止められないようにする
+        job.readers += 1
+        self.keep(job)
+        try:
+            while not job.finished.is_set():
+                if job.started.is_set() and os.path.getsize(job.path) > 0:
+                    return True
+                await asyncio.sleep(self.poll)
+            return job.state == DONE
+        finally:
+            self.release(job)
+
+    async def stream(self, job, chunk_size=256 * 1024):
+        job.readers += 1
+        self.keep(job)
+        try:
+            with open(job.path, "rb") as f:
+                while True:
+                    data = f.read(chunk_size)
+                    if data:
+                        yield data
+                        continue
+                    if job.finished.is_set():
+                        # 終了後の残りを出し切る
+                        data = f.read()
+                        if data and job.state == DONE:
+                            yield data
+                        return
+                    await asyncio.sleep(self.poll)
+        finally:
+            self.release(job)
+
+    def release(self, job):
+        job.readers -= 1
+        if job.readers:
+            return
+        if job.state == FAILED:
+            self.schedule_reap(job, 0)
+        else:
+            self.schedule_reap(job, self.linger if job.finished.is_set() else self.idle)
@@ -0,0 +1,138 @@
+import base64
+
+from bs4 import BeautifulSoup
+from lxml import etree
+
+
+# =========================
+# Nitter 検索結果のパース
+# =========================
+#
+# parse_x_tweets は lxml のツリーを1回だけ走査して本文・画像・動画をまとめて拾う。
+# 出力は BeautifulSoup 版（parse_x_tweets_soup）と完全に同じ。
+#
+#   python bench/bench_nitter.py   両者の比較
+
+HTML_PARSER = etree.HTMLParser()
+
+TIMELINE_ITEMS = etree.XPath(
+    "//*[contains(concat(' ', normalize-space(@class), ' '), ' timeline-item ')]"
+)
+
+# BeautifulSoup の get_text() が拾わない要素（中の文字列は Script などの別型になる）
+HIDDEN_TEXT = frozenset(("script", "style", "template", "rt", "rp"))
+
+
+def encode_media_url(url: str) -> str:
+    return base64.urlsafe_b64encode(url.encode()).decode()
+
+
+def decode_media_url(data: str) -> str:
+    return base64.urlsafe_b64decode(data.encode()).decode()
+
+
+def media_path(src, base):
+    if not src.startswith("http"):
+        src = base + src
+    return "/x/media?u=" + encode_media_url(src)
+
+
+def has_class(el, name):
+    value = el.get("class")
+    return value is not None and name in value.split()
+
+
+def collect_text(el, parts):
+    if el.text:
+        parts.append(el.text)
+    for child in el:
+        # コメント・処理命令は tag が文字列でない。末尾の文字列だけは親のもの
+        if isinstance(child.tag, str) and child.tag not in HIDDEN_TEXT:
+            collect_text(child, parts)
+        if child.tail:
+            parts.append(child.tail)
+
+
+def get_text(el):
+    # BeautifulSoup の get_text("\n", strip=True) と同じ結果
+    if el.tag in HIDDEN_TEXT or any(a.tag in HIDDEN_TEXT for a in el.iterancestors()):
+        return ""
+    parts = []
+    collect_text(el, parts)
+    return "\n".join(t for t in (p.strip() for p in parts) if t)
+
+
+def parse_x_tweets(html: str, base: str):
+    try:
+        root = etree.fromstring(html, HTML_PARSER)
+    except ValueError:
+        # エンコーディング宣言付きの文字列など lxml が直接読めないもの
+        return parse_x_tweets_soup(html, base)
+    if root is None:
+        return []
+
+    tweets = []
+    for item in TIMELINE_ITEMS(root):
+        content = None
+        images = []
+        videos = []
+
+        for el in item.iterdescendants():
+            tag = el.tag
+            if not isinstance(tag, str):
+                continue
+            if content is None and has_class(el, "tweet-content"):
+                content = el
+            if tag == "img":
+                # "a.still-image img"（祖先は item の外でもよい）
+                src = el.get("src")
+                if src and any(a.tag == "a" and has_class(a, "still-image") for a in el.iterancestors()):
+                    images.append(media_path(src, base))
+            elif tag == "source":
+                # "video source"
+                src = el.get("src")
+                if src and any(a.tag == "video" for a in el.iterancestors()):
+                    videos.append(media_path(src, base))
+
+        if content is None:
+            continue
+
+        tweets.append({
+            "text": get_text(content),
+            "images": images,
+            "videos": videos,
+        })
+
+    return tweets
+
+
+def parse_x_tweets_soup(html: str, base: str):
+    soup = BeautifulSoup(html, "lxml")
+    tweets = []
+
+    for item in soup.select(".timeline-item"):
+        content = item.select_one(".tweet-content")
+        if not content:
+            continue
+
+        text = content.get_text("\n", strip=True)
+
+        images = []
+        for img in item.select("a.still-image img"):
+            src = img.get("src")
+            if src:
+                images.append(media_path(src, base))
+
+        videos = []
+        for v in item.select("video source"):
+            src = v.get("src")
+            if src:
+                videos.append(media_path(src, base))
+
+        tweets.append({
+            "text": text,
+            "images": images,
+            "videos": videos,
+        })
+
+    return tweets
@@ -0,0 +1,82 @@
+from collections import OrderedDict
+import gzip
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# =========================
+# 描画済みページのキャッシュ（圧縮済みの本文を保持）
+# =========================
+#
+# 全員に同じ HTML を返すページ用。元データ（@cache の戻り値）と同じオブジェクトの間だけ
+# 有効で、データ側が取り直されたら別オブジェクトになるので自動的に描き直される。
+
+class Page:
+    __slots__ = ("source", "body", "gzip", "br")
+
+    def __init__(self, source, body, level):
+        self.source = source
+        self.body = body
+        self.gzip = gzip.compress(body, compresslevel=level)
+        self.br = brotli.compress(body, quality=level) if brotli else None
+
+    def select(self, accept_encoding):
+        # Accept-Encoding に合わせて (本文, Content-Encoding) を選ぶ
+        accepted = parse_accept_encoding(accept_encoding)
+        if self.br is not None and accepted.get("br", 0) > 0:
+            return self.br, "br"
+        if accepted.get("gzip", 0) > 0:
+            return self.gzip, "gzip"
+        return self.body, None
+
+
+def parse_accept_encoding(value):
+    accepted = {}
+    for part in (value or "").split(","):
+        name, _, params = part.strip().partition(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[name] = q
+    if "*" in accepted:
+        for name in ("br", "gzip"):
+            accepted.setdefault(name, accepted["*"])
+    return accepted
+
+
+class PageCache:
+    def __init__(self, max_entries=256, level=6):
+        self.max_entries = max_entries
+        self.level = level
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, source):
+        page = self.entries.get(key)
+        if page is None or page.source is not source:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return page
+
+    def put(self, key, source, html):
+        page = Page(source, html.encode(), self.level)
+        self.entries[key] = page
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+        return page
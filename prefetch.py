@@ -0,0 +1,89 @@
+import asyncio
+import logging
+import time
+
+
+# =========================
+# 関連動画の先読み（低優先度・全体で予算あり）
+# =========================
+#
+# /watch のあとに関連動画上位のメタデータを VideoStore に入れておく。
+# 1ワーカーで順番に処理し、トークンバケットで回数を制限、
+# 上流が遅い/失敗したら間隔を倍々で空ける。
+
+class Prefetcher:
+    def __init__(self, store, rate_per_minute=30, burst=6, queue_size=64, slow=2.0, max_backoff=60):
+        self.store = store
+        self.rate = rate_per_minute / 60
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.queued = set()
+        self.slow = slow
+        self.max_backoff = max_backoff
+        self.backoff = 0
+        self.task = None
+        self.fetched = 0
+        self.dropped = 0
+
+    def schedule(self, video_ids):
+        for video_id in video_ids:
+            if video_id in self.queued or self.store.peek(video_id) is not None:
+                continue
+            try:
+                self.queue.put_nowait(video_id)
+            except asyncio.QueueFull:
+                self.dropped += 1
+                return
+            self.queued.add(video_id)
+
+    async def take_token(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    async def run(self):
+        while True:
+            video_id = await self.queue.get()
+            self.queued.discard(video_id)
+            if self.store.peek(video_id) is not None:
+                continue
+            await self.take_token()
+
+            start = time.monotonic()
+            try:
+                await self.store.get(video_id)
+                ok = True
+                self.fetched += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.info(f"prefetch failed: {video_id}: {e}")
+                ok = False
+
+            if ok and time.monotonic() - start < self.slow:
+                self.backoff = self.backoff / 2 if self.backoff > 0.5 else 0
+            else:
+                self.backoff = min(max(self.backoff * 2, 1), self.max_backoff)
+            if self.backoff:
+                await asyncio.sleep(self.backoff)
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+        return self.task
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
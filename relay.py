@@ -0,0 +1,234 @@
+from collections import OrderedDict
+import asyncio
+import logging
+import re
+
+import httpx
+from starlette.exceptions import HTTPException
+from starlette.responses import Response, StreamingResponse
+
+import metrics
+
+
+# =========================
+# googlevideo 中継（チャンク単位のキャッシュ + 同時取得の統合）
+# =========================
+#
+# /relay/{video_id}/{itag} の Range 要求を chunk_size ごとに区切り、
+#   メモリ（LRU・max_memory バイト） -> ディスク（DiskStore） -> 上流
+# の順に探す。同じチャンクを同時に要求されても上流へは1回だけ取りに行く。
+# URL は resolve() で動画IDと itag から毎回引き、403/410 が返ったら取り直して1回だけ再試行する。
+
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+CONTENT_RANGE_RE = re.compile(r"/(\d+)$")
+
+
+class MemoryChunks:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.evictions = 0
+
+    def get(self, key):
+        data = self.entries.get(key)
+        if data is not None:
+            self.entries.move_to_end(key)
+        return data
+
+    def put(self, key, data):
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+        self.entries[key] = data
+        self.size += len(data)
+        while self.size > self.max_bytes and self.entries:
+            _, dropped = self.entries.popitem(last=False)
+            self.size -= len(dropped)
+            self.evictions += 1
+
+
+class StreamRelay:
+    # resolve: async (video_id, itag, refresh) -> (url, mime) / 見つからなければ None
+    # client: () -> httpx.AsyncClient / disk: DiskStore
+    def __init__(self, resolve, client, disk, max_memory=64 * 1024 * 1024, chunk_size=1024 * 1024,
+                 readahead=2, max_sizes=4096):
+        self.resolve = resolve
+        self.client = client
+        self.disk = disk
+        self.memory = MemoryChunks(max_memory)
+        self.chunk_size = chunk_size
+        self.readahead = readahead
+        self.max_sizes = max_sizes
+        self.sizes = OrderedDict()  # (video_id, itag) -> (全体のバイト数, mime)
+        self.inflight = {}
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    # ---------- 上流 ----------
+
+    async def fetch(self, video_id, itag, index):
+        start = index * self.chunk_size
+        end = start + self.chunk_size - 1
+        for refresh in (False, True):
+            found = await self.resolve(video_id, itag, refresh)
+            if found is None:
+                raise HTTPException(status_code=404)
+            url, mime = found
+            try:
+                # ホスト名（rr3---sn-xxxx）はラベルにすると増え続けるのでまとめる
+                with metrics.outbound("relay", "googlevideo", "videoplayback"):
+                    async with self.client().stream("GET", url, headers={"Range": f"bytes={start}-{end}"}) as r:
+                        if r.status_code in (403, 410) and not refresh:
+                            # URL の期限切れ。取り直して1回だけやり直す
+                            continue
+                        if r.status_code == 206:
+                            m = CONTENT_RANGE_RE.search(r.headers.get("content-range", ""))
+                            total = int(m.group(1)) if m else None
+                            data = await r.aread()
+                        elif r.status_code == 200:
+                            # Range を無視された。全体（数百MBになり得る）は読まず end までで打ち切る
+                            length = r.headers.get("content-length", "")
+                            total = int(length) if length.isdigit() else None
+                            data = await read_prefix(r, end + 1)
+                            if total is None and len(data) <= end:
+                                # 最後まで読めたので長さが分かる
+                                total = len(data)
+                            data = data[start:]
+                        else:
+                            raise HTTPException(status_code=404 if r.status_code in (404, 416) else 502)
+            except httpx.HTTPError:
+                # 接続できない・途中で切れたなど。/thumbnail と同じく上流の失敗として返す
+                raise HTTPException(status_code=502)
+            # 途中で切れたものはキャッシュしない
+            if total is not None and len(data) != min(end, total - 1) - start + 1:
+                raise HTTPException(status_code=502)
+            return data, total, mime
+        raise HTTPException(status_code=502)
+
+    def remember_size(self, video_id, itag, total, mime):
+        if total is None:
+            return
+        self.sizes[(video_id, itag)] = (total, mime)
+        self.sizes.move_to_end((video_id, itag))
+        while len(self.sizes) > self.max_sizes:
+            self.sizes.popitem(last=False)
+
+    # ---------- チャンク ----------
+
+    async def chunk(self, video_id, itag, index):
+        key = f"{video_id}/{itag}/{index}"
+        data = self.memory.get(key)
+        if data is not None:
+            self.memory_hits += 1
+            return data
+
+        entry = self.disk.get(key)
+        if entry is not None:
+            self.disk_hits += 1
+            with open(entry[0], "rb") as f:
+                data = f.read()
+            self.memory.put(key, data)
+            return data
+
+        task = self.inflight.get(key)
+        if task is None:
+            self.misses += 1
+
+            async def run():
+                try:
+                    data, total, mime = await self.fetch(video_id, itag, index)
+                    self.remember_size(video_id, itag, total, mime)
+                    self.memory.put(key, data)
+                    await self.disk.put(key, one(data))
+                    return data
+                finally:
+                    self.inflight.pop(key, None)
+
+            task = self.inflight[key] = asyncio.ensure_future(run())
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    async def size(self, video_id, itag):
+        known = self.sizes.get((video_id, itag))
+        if known is None:
+            # 先頭チャンクの Content-Range から全体の長さが分かる
+            await self.chunk(video_id, itag, 0)
+            known = self.sizes.get((video_id, itag))
+        if known is None:
+            raise HTTPException(status_code=502)
+        return known
+
+    async def body(self, video_id, itag, start, end, first):
+        # start..end（両端含む）を順に返す。readahead 個先まで並行して取っておく
+        first_index = start // self.chunk_size
+        last = end // self.chunk_size
+        tasks = {}
+        try:
+            for i in range(first_index, last + 1):
+                for j in range(i + 1, min(i + self.readahead, last) + 1):
+                    if j not in tasks:
+                        tasks[j] = asyncio.ensure_future(self.chunk(video_id, itag, j))
+                if i == first_index:
+                    data = first
+                else:
+                    task = tasks.pop(i, None)
+                    try:
+                        data = await (task or self.chunk(video_id, itag, i))
+                    except HTTPException as e:
+                        # ヘッダーは送った後なのでステータスは変えられない。ここで打ち切る
+                        logging.warning(f"relay upstream failed: {video_id}/{itag} chunk {i}: {e.status_code}")
+                        return
+                base = i * self.chunk_size
+                yield data[max(start - base, 0):end - base + 1]
+        finally:
+            for t in tasks.values():
+                t.cancel()
+
+    # ---------- 応答 ----------
+
+    async def respond(self, request, video_id, itag):
+        total, mime = await self.size(video_id, itag)
+        headers = {"Accept-Ranges": "bytes", "Cache-Control": "private, max-age=3600"}
+
+        value = request.headers.get("range")
+        m = RANGE_RE.match(value.strip()) if value else None
+        if m is None or m.group(1) == m.group(2) == "":
+            start, end, status = 0, total - 1, 200
+        else:
+            status = 206
+            if m.group(1) == "":
+                start, end = max(total - int(m.group(2)), 0), total - 1
+            else:
+                start = int(m.group(1))
+                end = min(int(m.group(2)), total - 1) if m.group(2) else total - 1
+            if start >= total or start > end:
+                return Response(status_code=416, headers={"Content-Range": f"bytes */{total}"})
+            headers["Content-Range"] = f"bytes {start}-{end}/{total}"
+        headers["Content-Length"] = str(end - start + 1)
+
+        # 最初のチャンクは応答前に取る（失敗をステータスで返せるように）
+        first = await self.chunk(video_id, itag, start // self.chunk_size)
+        return StreamingResponse(
+            self.body(video_id, itag, start, end, first),
+            status_code=status,
+            media_type=mime,
+            headers=headers,
+        )
+
+
+async def one(data):
+    yield data
+
+
+async def read_prefix(r, limit):
+    # ストリーミング中のレスポンスから先頭 limit バイトだけ読む
+    buf = bytearray()
+    async for chunk in r.aiter_bytes():
+        buf += chunk
+        if len(buf) >= limit:
+            break
+    return bytes(buf[:limit])
@@ -0,0 +1,129 @@
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+import sys
+
+from starlette.datastructures import Headers
+from starlette.staticfiles import StaticFiles
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from pagecache import parse_accept_encoding
+
+
+# =========================
+# 静的ファイル（圧縮済みサイドカー + ハッシュ付きファイル名）
+# =========================
+#
+#   python staticassets.py css blog   ビルド時にサイドカーを作る（起動時にも不足分は作る）
+#
+# default.css -> default.css.br / default.css.gz を一度だけ作り、Accept-Encoding に合わせて返す。
+# default.<hash>.css で参照されたら中身が変わらないので immutable で返す。
+
+COMPRESSIBLE = (".css", ".js", ".html", ".htm", ".svg", ".json", ".txt", ".xml")
+SIDECARS = (("br", ".br"), ("gzip", ".gz"))
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "public, max-age=0, must-revalidate"
+
+
+def build_sidecars(directory):
+    for root, _, files in os.walk(directory):
+        for name in files:
+            if not name.endswith(COMPRESSIBLE):
+                continue
+            path = os.path.join(root, name)
+            mtime = os.path.getmtime(path)
+            with open(path, "rb") as f:
+                data = None
+                for encoding, suffix in SIDECARS:
+                    target = path + suffix
+                    if encoding == "br" and brotli is None:
+                        continue
+                    if os.path.exists(target) and os.path.getmtime(target) >= mtime:
+                        continue
+                    if data is None:
+                        data = f.read()
+                    if encoding == "br":
+                        body = brotli.compress(data, quality=11)
+                    else:
+                        body = gzip.compress(data, compresslevel=9, mtime=0)
+                    try:
+                        with open(target, "wb") as out:
+                            out.write(body)
+                    except OSError as e:
+                        logging.warning(f"sidecar write failed: {target}: {e}")
+
+
+def fingerprint(directory):
+    # "default.css" -> "default.0123456789.css"
+    names = {}
+    for root, _, files in os.walk(directory):
+        for name in files:
+            if name.endswith(tuple(suffix for _, suffix in SIDECARS)):
+                continue
+            path = os.path.join(root, name)
+            with open(path, "rb") as f:
+                digest = hashlib.sha256(f.read()).hexdigest()[:10]
+            rel = os.path.relpath(path, directory).replace(os.sep, "/")
+            base, ext = os.path.splitext(rel)
+            names[rel] = f"{base}.{digest}{ext}"
+    return names
+
+
+class PrecompressedStaticFiles(StaticFiles):
+    def __init__(self, *, directory, build=True, **kwargs):
+        super().__init__(directory=directory, **kwargs)
+        if build:
+            build_sidecars(directory)
+        self.fingerprints = fingerprint(directory)
+        self.originals = {v: k for k, v in self.fingerprints.items()}
+
+    def url(self, name):
+        return self.fingerprints.get(name, name)
+
+    async def get_response(self, path, scope):
+        rel = path.replace(os.sep, "/")
+        original = self.originals.get(rel)
+        immutable = original is not None
+        if original is None:
+            original = rel
+            if self.html and (rel in ("", ".") or rel.endswith("/")):
+                original = (rel.rstrip("/") + "/index.html").lstrip("./")
+
+        response = None
+        if original.endswith(COMPRESSIBLE):
+            accepted = parse_accept_encoding(Headers(scope=scope).get("accept-encoding"))
+            for encoding, suffix in SIDECARS:
+                if accepted.get(encoding, 0) <= 0:
+                    continue
+                full_path, stat_result = self.lookup_path(original + suffix)
+                if stat_result is None:
+                    continue
+                response = self.file_response(full_path, stat_result, scope)
+                response.headers["content-encoding"] = encoding
+                response.media_type = mimetypes.guess_type(original)[0] or "application/octet-stream"
+                response.headers["content-type"] = (
+                    response.media_type + "; charset=utf-8"
+                    if response.media_type.startswith("text/") else response.media_type
+                )
+                break
+        if response is None:
+            response = await super().get_response(original, scope)
+
+        if original.endswith(COMPRESSIBLE):
+            response.headers["vary"] = "Accept-Encoding"
+        if response.status_code in (200, 304):
+            response.headers["cache-control"] = IMMUTABLE if immutable else REVALIDATE
+        return response
+
+
+if __name__ == "__main__":
+    for d in sys.argv[1:] or ["css", "blog"]:
+        build_sidecars(d)
+        print(d, "ok")
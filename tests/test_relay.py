@@ -0,0 +1,48 @@
+import os
+import sys
+
+import httpx
+from starlette.applications import Starlette
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from diskstore import DiskStore
+from relay import StreamRelay
+
+
+def relay_client(tmp_path, handler):
+    async def resolve(video_id, itag, refresh=False):
+        return "https://rr1---sn-test.googlevideo.com/videoplayback", "video/mp4"
+
+    upstream = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    relay = StreamRelay(resolve, lambda: upstream, DiskStore(str(tmp_path), max_bytes=1024 * 1024), chunk_size=1000)
+
+    async def endpoint(request):
+        return await relay.respond(request, request.path_params["video_id"], request.path_params["itag"])
+
+    return TestClient(Starlette(routes=[Route("/relay/{video_id}/{itag}", endpoint)]))
+
+
+def test_transport_error_is_502(tmp_path):
+    def handler(request):
+        raise httpx.ConnectError("connection refused", request=request)
+
+    r = relay_client(tmp_path, handler).get("/relay/jNQXAC9IVRw/137", headers={"Range": "bytes=0-499"})
+    assert r.status_code == 502
+
+
+def test_later_chunk_failure_ends_stream(tmp_path):
+    blob = bytes(range(256)) * 10
+
+    def handler(request):
+        start, end = map(int, request.headers["range"][len("bytes="):].split("-"))
+        if start > 0:
+            raise httpx.ReadTimeout("timed out", request=request)
+        return httpx.Response(206, content=blob[start:end + 1],
+                              headers={"Content-Range": f"bytes {start}-{end}/{len(blob)}"})
+
+    r = relay_client(tmp_path, handler).get("/relay/jNQXAC9IVRw/137")
+    assert r.status_code == 200
+    assert r.content == blob[:1000]
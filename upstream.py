@@ -0,0 +1,393 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import deque
+
+import metrics
+
+
+# orjson があれば高速デコード（無ければ標準の json）。どちらも bytes/str を受け付ける
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+
+class UpstreamError(Exception):
+    pass
+
+
+# =========================
+# サーキットブレーカー（インスタンス×機能ごと）
+# =========================
+
+CLOSED, HALF_OPEN, OPEN = 0, 1, 2
+
+
+class CircuitBreaker:
+    __slots__ = ("failures", "opened_at", "cooldown")
+
+    def __init__(self, cooldown):
+        self.failures = 0
+        self.opened_at = None  # time.time()（再起動後も使えるよう壁時計）
+        self.cooldown = cooldown
+
+    def state(self, now):
+        if self.opened_at is None:
+            return CLOSED
+        if now - self.opened_at < self.cooldown:
+            return OPEN
+        return HALF_OPEN
+
+    def record(self, ok, now, threshold, base_cooldown, max_cooldown):
+        if ok:
+            self.failures = 0
+            self.opened_at = None
+            self.cooldown = base_cooldown
+            return
+        was_half_open = self.state(now) == HALF_OPEN
+        self.failures += 1
+        if was_half_open:
+            # 復帰確認に失敗したら開く時間を倍に
+            self.cooldown = min(self.cooldown * 2, max_cooldown)
+            self.opened_at = now
+        elif self.failures >= threshold:
+            self.opened_at = now
+
+
+# =========================
+# インスタンスごとの成績
+# =========================
+
+class InstanceStats:
+    __slots__ = ("latency", "success", "samples")
+
+    def __init__(self, latency):
+        self.latency = latency  # EWMA（秒）
+        self.success = 1.0      # EWMA 成功率
+        self.samples = 0
+
+
+class InstancePool:
+    # width: 同時に投げる最大数 / hedge_delay: 次を追加するまでの秒数（None なら p90 から自動）
+    def __init__(self, name, instances, width=2, hedge_delay=None, max_attempts=8,
+                 alpha=0.3, window=64, default_latency=1.0, min_delay=0.05, max_delay=3.0,
+                 breaker_threshold=3, breaker_cooldown=30, breaker_max_cooldown=600):
+        self.name = name
+        # 呼び出し側のリストを後から並べ替えられても影響しないよう固定したコピーを持つ
+        self.instances = tuple(instances)
+        self.width = max(1, width)
+        self.fixed_delay = hedge_delay
+        self.max_attempts = max_attempts
+        self.alpha = alpha
+        self.default_latency = default_latency
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.breaker_max_cooldown = breaker_max_cooldown
+        self.stats = {}
+        self.breakers = {}
+        self.window = window
+        self.recent = deque(maxlen=window)  # プール全体（機能ごとの記録が無い時用）
+        self.recent_by = {}                 # capability -> deque
+
+    def stat(self, instance):
+        s = self.stats.get(instance)
+        if s is None:
+            s = self.stats[instance] = InstanceStats(self.default_latency)
+        return s
+
+    def score(self, instance):
+        # 期待コスト = 遅延 / 成功率（小さいほど良い）
+        s = self.stat(instance)
+        return s.latency / max(s.success, 0.05)
+
+    def breaker(self, instance, capability):
+        b = self.breakers.get((instance, capability))
+        if b is None:
+            b = self.breakers[(instance, capability)] = CircuitBreaker(self.breaker_cooldown)
+        return b
+
+    def state(self, instance, capability, now=None):
+        if capability is None:
+            return CLOSED
+        b = self.breakers.get((instance, capability))
+        if b is None:
+            return CLOSED
+        return b.state(time.time() if now is None else now)
+
+    def ranked(self, capability=None):
+        # 閉 → 半開 → 開 の順、同じ状態内は期待コスト順（同点ならリストの並び順）
+        now = time.time()
+        return sorted(
+            self.instances,
+            key=lambda i: (self.state(i, capability, now), self.score(i)),
+        )
+
+    def record(self, instance, latency, ok, capability=None):
+        if capability is not None:
+            self.breaker(instance, capability).record(
+                ok, time.time(), self.breaker_threshold,
+                self.breaker_cooldown, self.breaker_max_cooldown,
+            )
+        s = self.stat(instance)
+        a = self.alpha
+        if s.samples == 0:
+            s.latency = latency if ok else max(latency, s.latency)
+        elif ok:
+            s.latency = (1 - a) * s.latency + a * latency
+        else:
+            # 失敗は遅延にもペナルティ
+            s.latency = (1 - a) * s.latency + a * max(latency, s.latency)
+        s.success = (1 - a) * s.success + a * (1.0 if ok else 0.0)
+        s.samples += 1
+        if ok:
+            self.recent.append(latency)
+            if capability is not None:
+                self.recent_window(capability).append(latency)
+
+    def record_cancelled(self, instance, elapsed):
+        # ヘッジで負けてキャンセルされた: 少なくとも elapsed 秒はかかる（打ち切られた標本）。
+        # 失敗には数えず、遅延の見積もりだけ elapsed 以上に引き上げる
+        s = self.stat(instance)
+        s.latency = max(s.latency, elapsed)
+
+    def recent_window(self, capability):
+        recent = self.recent_by.get(capability)
+        if recent is None:
+            recent = self.recent_by[capability] = deque(maxlen=self.window)
+        return recent
+
+    def hedge_delay(self, capability=None):
+        # 機能ごとの p90（search と videos では応答の大きさが違う）。記録が無ければプール全体
+        if self.fixed_delay is not None:
+            return self.fixed_delay
+        recent = self.recent_by.get(capability) or self.recent
+        if not recent:
+            return self.max_delay / 2
+        lat = sorted(recent)
+        p90 = lat[int(0.9 * (len(lat) - 1))]
+        return min(max(p90, self.min_delay), self.max_delay)
+
+
+# =========================
+# ヘッジ付きリクエスト
+# =========================
+
+async def race(pool, fetch, timeout, capability=None):
+    # 最良の1台に投げ、hedge_delay 内に返らなければ width まで追加。
+    # 失敗したら即座に次の候補へ。最初の成功で残りはすべてキャンセル。
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    ranked = pool.ranked(capability)
+    healthy = [i for i in ranked if pool.state(i, capability) != OPEN]
+    # 全滅扱いのときだけ開いているインスタンスにも投げる
+    candidates = iter((healthy or ranked)[:pool.max_attempts])
+    pending = set()
+
+    endpoint = capability or "other"
+
+    async def attempt(instance):
+        start = time.monotonic()
+        try:
+            with metrics.outbound(pool.name, instance, endpoint):
+                result = await fetch(instance)
+        except asyncio.CancelledError:
+            pool.record_cancelled(instance, time.monotonic() - start)
+            raise
+        except Exception:
+            pool.record(instance, time.monotonic() - start, False, capability)
+            raise
+        pool.record(instance, time.monotonic() - start, True, capability)
+        return result
+
+    def launch():
+        instance = next(candidates, None)
+        if instance is None:
+            return False
+        pending.add(asyncio.ensure_future(attempt(instance)))
+        return True
+
+    launch()
+    try:
+        while pending:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            can_hedge = len(pending) < pool.width
+            wait = min(remaining, pool.hedge_delay(capability)) if can_hedge else remaining
+            done, _ = await asyncio.wait(pending, timeout=wait, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                if can_hedge:
+                    launch()
+                continue
+            for t in done:
+                pending.discard(t)
+                if t.exception() is None:
+                    return t.result()
+            for _ in done:
+                launch()
+    finally:
+        for t in pending:
+            t.cancel()
+
+    metrics.upstream_exhausted.inc(pool.name, endpoint)
+    raise UpstreamError(f"{pool.name}: all instances failed")
+
+
+# =========================
+# ヘルスチェック（バックグラウンド）
+# =========================
+
+# 機能ごとの軽いプローブ先（Me at the zoo / jawed）
+PROBE_PATHS = {
+    "search": "api/v1/search?q=test",
+    "videos": "api/v1/videos/jNQXAC9IVRw",
+    "channels": "api/v1/channels/UC4QobU6STFB0P71PMvOGN5A",
+    "comments": "api/v1/comments/jNQXAC9IVRw",
+    "popular": "api/v1/popular",
+}
+
+
+def instance_url(instance, path):
+    return instance.rstrip("/") + "/" + path
+
+
+class Prober:
+    # targets: [(pool, capability), ...] / client: httpx.AsyncClient を返す関数
+    def __init__(self, targets, client, interval=120, concurrency=8, timeout=5, path=None):
+        self.targets = targets
+        self.client = client
+        self.interval = interval
+        self.timeout = timeout
+        self.path = path
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.task = None
+
+    async def probe(self, pool, capability, instance):
+        async with self.semaphore:
+            start = time.monotonic()
+            try:
+                r = await self.client().get(
+                    instance_url(instance, PROBE_PATHS[capability]), timeout=self.timeout
+                )
+                r.raise_for_status()
+                json_loads(r.content)
+                ok = True
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                ok = False
+            pool.record(instance, time.monotonic() - start, ok, capability)
+
+    async def run_once(self):
+        await asyncio.gather(*(
+            self.probe(pool, capability, instance)
+            for pool, capability in self.targets
+            for instance in pool.instances
+        ))
+        if self.path:
+            save_scoreboard(self.path, self.pools())
+
+    def pools(self):
+        pools = []
+        for pool, _ in self.targets:
+            if pool not in pools:
+                pools.append(pool)
+        return pools
+
+    async def run(self):
+        while True:
+            try:
+                await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.warning(f"probe error: {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self.path:
+            load_scoreboard(self.path, self.pools())
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+        return self.task
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        if self.path:
+            save_scoreboard(self.path, self.pools())
+
+
+# =========================
+# スコアボード永続化（コールドスタート対策）
+# =========================
+
+def save_scoreboard(path, pools):
+    data = {}
+    for pool in pools:
+        breakers = {}
+        for (instance, capability), b in pool.breakers.items():
+            breakers.setdefault(instance, {})[capability] = {
+                "failures": b.failures,
+                "opened_at": b.opened_at,
+                "cooldown": b.cooldown,
+            }
+        data[pool.name] = {
+            "recent": list(pool.recent),
+            "recent_by": {capability: list(recent) for capability, recent in pool.recent_by.items()},
+            "instances": {
+                instance: {
+                    "latency": s.latency,
+                    "success": s.success,
+                    "samples": s.samples,
+                    "breakers": breakers.get(instance, {}),
+                }
+                for instance, s in pool.stats.items()
+            },
+        }
+    tmp = path + ".tmp"
+    try:
+        with open(tmp, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
+    except OSError as e:
+        logging.warning(f"scoreboard save failed: {e}")
+
+
+def load_scoreboard(path, pools):
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return
+    for pool in pools:
+        saved = data.get(pool.name)
+        if not isinstance(saved, dict):
+            continue
+        try:
+            pool.recent.extend(saved.get("recent", []))
+            for capability, recent in saved.get("recent_by", {}).items():
+                pool.recent_window(capability).extend(recent)
+            for instance, v in saved.get("instances", {}).items():
+                s = pool.stat(instance)
+                s.latency = v["latency"]
+                s.success = v["success"]
+                s.samples = v["samples"]
+                for capability, b in v.get("breakers", {}).items():
+                    breaker = pool.breaker(instance, capability)
+                    breaker.failures = b["failures"]
+                    breaker.opened_at = b["opened_at"]
+                    breaker.cooldown = b["cooldown"]
+        except (KeyError, TypeError, AttributeError):
+            continue
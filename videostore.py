@@ -0,0 +1,115 @@
+from collections import OrderedDict
+import asyncio
+import re
+import time
+
+
+# =========================
+# 動画メタデータストア（stale-while-revalidate）
+# =========================
+#
+# api/v1/videos/{id} の結果を動画IDごとに1つだけ持つ。
+# 新鮮な間はそのまま返し、期限切れでもストリームURLが有効な間は古い値を返しつつ
+# 裏で取り直す。googlevideo の expire を過ぎた値は絶対に返さない。
+
+EXPIRE_RE = re.compile(r"[?&/]expire[=/](\d+)")
+
+
+def stream_expiry(doc):
+    # 含まれるストリームURLのうち最も早い expire（UNIX秒）。無ければ None
+    urls = [f.get("url") or "" for f in doc.get("formatStreams", [])]
+    urls += [f.get("url") or "" for f in doc.get("adaptiveFormats", [])]
+    urls.append(doc.get("hlsUrl") or "")
+    found = [int(m.group(1)) for m in map(EXPIRE_RE.search, urls) if m]
+    return min(found) if found else None
+
+
+class VideoStore:
+    # fetch: async (video_id) -> 値 / expiry: 値 -> expire（UNIX秒 or None）
+    # fresh_ttl: 取り直さずに返す秒数 / stale_ttl: URLが無い動画を古いまま返してよい秒数
+    # margin: expire の何秒前から使わないか
+    def __init__(self, fetch, max_entries=512, fresh_ttl=300, stale_ttl=3600, margin=300, expiry=stream_expiry):
+        self.fetch = fetch
+        self.expiry = expiry
+        self.max_entries = max_entries
+        self.fresh_ttl = fresh_ttl
+        self.stale_ttl = stale_ttl
+        self.margin = margin
+        self.entries = OrderedDict()  # video_id -> (doc, fresh_until, hard_until)
+        self.inflight = {}
+        self.refreshing = set()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+
+    def lifetimes(self, doc, now):
+        expire = self.expiry(doc)
+        if expire is None:
+            hard = now + self.stale_ttl
+        else:
+            hard = expire - self.margin
+        return min(now + self.fresh_ttl, hard), hard
+
+    def put(self, video_id, doc):
+        now = time.time()
+        fresh, hard = self.lifetimes(doc, now)
+        if hard <= now:
+            # 最初から期限切れのURLはキャッシュしない
+            self.entries.pop(video_id, None)
+            return
+        self.entries[video_id] = (doc, fresh, hard)
+        self.entries.move_to_end(video_id)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def peek(self, video_id):
+        # 有効な値があれば返す（取得はしない）
+        entry = self.entries.get(video_id)
+        if entry is None or time.time() >= entry[2]:
+            return None
+        return entry[0]
+
+    def invalidate(self, video_id):
+        self.entries.pop(video_id, None)
+
+    async def load(self, video_id):
+        task = self.inflight.get(video_id)
+        if task is None:
+            async def run():
+                try:
+                    doc = await self.fetch(video_id)
+                    self.put(video_id, doc)
+                    return doc
+                finally:
+                    self.inflight.pop(video_id, None)
+
+            task = self.inflight[video_id] = asyncio.ensure_future(run())
+        return await asyncio.shield(task)
+
+    def refresh(self, video_id):
+        if video_id in self.inflight:
+            return
+        task = asyncio.ensure_future(self.load(video_id))
+        self.refreshing.add(task)
+        # 裏の取り直しが失敗しても古い値はそのまま
+        task.add_done_callback(lambda t: (self.refreshing.discard(t), t.cancelled() or t.exception()))
+
+    async def get(self, video_id):
+        now = time.time()
+        entry = self.entries.get(video_id)
+        if entry is not None:
+            doc, fresh, hard = entry
+            if now < fresh:
+                self.hits += 1
+                self.entries.move_to_end(video_id)
+                return doc
+            if now < hard:
+                self.stale += 1
+                self.entries.move_to_end(video_id)
+                self.refresh(video_id)
+                return doc
+            del self.entries[video_id]
+        self.misses += 1
+        return await self.load(video_id)
@@ -1,16 +1,33 @@
 import os
 import time
 import logging
-from flask import Flask, jsonify, request, send_from_directory
+import subprocess
+import threading
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+from flask import Flask, Response, g, jsonify, request, send_from_directory
 from omada import OmadaVideoService
 import requests
-from moviepy.editor import VideoFileClip, AudioFileClip
+from filecache import FileCache
+import metrics
 from tempfile import NamedTemporaryFile
 
 # ===================== 設定 =====================
 CACHE_DIR = "cache"
 CACHE_TTL = 3600 * 6  # キャッシュ6時間
+CACHE_MAX_BYTES = int(os.environ.get("CACHE_MAX_BYTES", 4 * 1024 ** 3))  # 結合済み動画の合計上限
 TARGET_QUALITIES = ["1080p", "720p", "480p", "360p"]  # 高画質優先
+FFMPEG = os.environ.get("FFMPEG", "ffmpeg")
+FFPROBE = os.environ.get("FFPROBE", "ffprobe")
+# MP4 にそのまま入れられるコーデック（これ以外の時だけ再エンコード）
+MP4_VIDEO_CODECS = {"h264", "hevc", "av1", "vp9"}
+MP4_AUDIO_CODECS = {"aac", "mp3", "opus"}
+# 断片化MP4: moov を先頭に置き、書き込み中でも先頭から再生できる
+MP4_MOVFLAGS = "+frag_keyframe+empty_moov+default_base_moof"
+# 分割ダウンロード（googlevideo は1接続あたりの速度を絞るので Range で並列に取る）
+DOWNLOAD_PART_SIZE = int(os.environ.get("DOWNLOAD_PART_SIZE", 8 * 1024 * 1024))
+DOWNLOAD_CONCURRENCY = int(os.environ.get("DOWNLOAD_CONCURRENCY", 4))  # 1ストリームあたり
+DOWNLOAD_RETRIES = int(os.environ.get("DOWNLOAD_RETRIES", 3))
+DOWNLOAD_TIMEOUT = (5, 30)  # (接続, 読み込み)
 INVIDIOUS_SITES = [
     'https://invidious.schenkel.eti.br/',
     'https://invidious.nikkosphere.com/',
@@ -49,74 +66,305 @@ logging.basicConfig(level=logging.INFO)
 app = Flask(__name__)
 video_service = OmadaVideoService()
 
-# ===================== キャッシュ整理 =====================
-def cleanup_cache():
-    now = time.time()
-    for filename in os.listdir(CACHE_DIR):
-        filepath = os.path.join(CACHE_DIR, filename)
-        if os.path.isfile(filepath) and now - os.path.getmtime(filepath) > CACHE_TTL:
-            logging.info(f"古いキャッシュ削除: {filename}")
-            os.remove(filepath)
+download_session = requests.Session()
+download_session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=DOWNLOAD_CONCURRENCY * 2))
+
+# ===================== キャッシュ =====================
+# 索引と追い出しは FileCache（裏スレッド）に任せ、リクエストごとの走査はしない
+video_cache = FileCache(CACHE_DIR, CACHE_MAX_BYTES, ttl=CACHE_TTL)
+video_cache.start()
+
+# このプロセスで結合中のジョブ（同じファイルへの同時リクエストは1つにまとめる）
+merge_jobs = {}
+merge_jobs_lock = threading.Lock()
+
+# ===================== メトリクス =====================
+metrics.REGISTRY.watch_cache("video_cache", video_cache)
+
+@app.before_request
+def start_timer():
+    g.request_start = time.monotonic()
+    metrics.route_inflight.inc()
+
+@app.teardown_request
+def stop_timer(error=None):
+    if "request_start" in g:
+        metrics.route_inflight.dec()
+
+@app.after_request
+def record_route(response):
+    if "request_start" in g:
+        # ラベルは実際のURLではなくルートの定義（"/video/<video_id>" など）
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        metrics.observe_route(request.method, route, response.status_code, time.monotonic() - g.request_start)
+    return response
+
+if metrics.endpoint_enabled():
+    @app.route("/metrics")
+    def metrics_endpoint():
+        if not metrics.authorized(request.headers.get("Authorization"), request.args.get("token")):
+            return jsonify({"error": "forbidden"}), 403
+        return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+def get_stream_urls(video_id, **kwargs):
+    # Omada 側のインスタンス選択は見えないので1つにまとめて計る
+    with metrics.outbound("omada", "omada", "streams"):
+        return video_service.get_stream_urls(video_id, **kwargs)
 
 # ===================== 動画取得・結合 =====================
-def download_stream(url, tmp_suffix=".mp4"):
+def content_length(r):
+    # "Content-Range: bytes 0-0/12345" -> 12345
+    total = r.headers.get("Content-Range", "").rpartition("/")[2]
+    return int(total) if total.isdigit() else None
+
+class DownloadAborted(Exception):
+    # 他のパート（またはもう一方のストリーム）が失敗したので止めた
+    pass
+
+def fetch_range(url, fd, start, end, abort):
+    # start..end（両端含む）を fd の同じ位置に書く。途中で切れたら続きから取り直す
+    pos = start
+    error = None
+    for attempt in range(DOWNLOAD_RETRIES + 1):
+        if abort.is_set():
+            raise DownloadAborted()
+        if attempt:
+            time.sleep(min(0.5 * 2 ** attempt, 5))
+        try:
+            with metrics.outbound("download", "googlevideo", "videoplayback"), \
+                    download_session.get(url, headers={"Range": f"bytes={pos}-{end}"}, stream=True, timeout=DOWNLOAD_TIMEOUT) as r:
+                if r.status_code != 206:
+                    raise IOError(f"Range が効かない: HTTP {r.status_code}")
+                for chunk in r.iter_content(chunk_size=256*1024):
+                    if abort.is_set():
+                        raise DownloadAborted()
+                    os.pwrite(fd, chunk, pos)
+                    pos += len(chunk)
+            if pos > end:
+                return
+            error = IOError(f"途中で切断: {pos - start}/{end - start + 1} bytes")
+        except (requests.RequestException, IOError) as e:
+            error = e
+        logging.warning(f"パート再試行 {start}-{end} ({attempt + 1}/{DOWNLOAD_RETRIES + 1}): {error}")
+    raise IOError(f"パート取得失敗 {start}-{end}: {error}")
+
+def download_stream(url, abort, tmp_suffix=".mp4"):
     tmp_file = NamedTemporaryFile(delete=False, suffix=tmp_suffix)
     logging.info(f"ダウンロード: {url}")
-    with requests.get(url, stream=True) as r:
-        r.raise_for_status()
-        for chunk in r.iter_content(chunk_size=1024*1024):
-            if chunk:
-                tmp_file.write(chunk)
-    tmp_file.close()
-    return tmp_file.name
+    try:
+        with download_session.get(url, headers={"Range": "bytes=0-0"}, stream=True, timeout=DOWNLOAD_TIMEOUT) as r:
+            r.raise_for_status()
+            total = content_length(r) if r.status_code == 206 else None
+            if total is None:
+                # Range 非対応なら従来どおり1本で取る
+                for chunk in r.iter_content(chunk_size=1024*1024):
+                    if abort.is_set():
+                        raise DownloadAborted()
+                    if chunk:
+                        tmp_file.write(chunk)
+                tmp_file.close()
+                return tmp_file.name
+
+        tmp_file.truncate(total)
+        tmp_file.flush()
+        fd = tmp_file.fileno()
+        parts = [(start, min(start + DOWNLOAD_PART_SIZE, total) - 1) for start in range(0, total, DOWNLOAD_PART_SIZE)]
+        with ThreadPoolExecutor(max_workers=min(DOWNLOAD_CONCURRENCY, len(parts) or 1)) as pool:
+            futures = [pool.submit(fetch_range, url, fd, start, end, abort) for start, end in parts]
+            done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+            failed = next((f.exception() for f in done if f.exception() is not None), None)
+            if failed is not None:
+                # 残りのパートは取らない。実行中のものは abort を見てすぐ抜ける
+                # （fd を閉じる前に止まるのを待つため shutdown は wait=True）
+                abort.set()
+                pool.shutdown(wait=True, cancel_futures=True)
+                raise failed
+        tmp_file.close()
+        return tmp_file.name
+    except Exception:
+        tmp_file.close()
+        os.unlink(tmp_file.name)
+        raise
+
+def download_pair(video_url, audio_url):
+    # 映像と音声を同時に取る。片方が失敗したらもう片方も止める
+    abort = threading.Event()
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        futures = [pool.submit(download_stream, video_url, abort), pool.submit(download_stream, audio_url, abort)]
+        done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+        if any(f.exception() is not None for f in done):
+            abort.set()
+    files = [f.result() for f in futures if f.exception() is None]
+    if len(files) < 2:
+        for path in files:
+            os.unlink(path)
+        # 止めた側の DownloadAborted ではなく元の失敗を返す
+        errors = [f.exception() for f in futures if f.exception() is not None]
+        raise next((e for e in errors if not isinstance(e, DownloadAborted)), errors[0])
+    return files
+
+def probe_codec(path, stream):
+    # stream: "v" / "a"。分からなければ None
+    try:
+        r = subprocess.run(
+            [FFPROBE, "-v", "error", "-select_streams", f"{stream}:0",
+             "-show_entries", "stream=codec_name", "-of", "csv=p=0", path],
+            capture_output=True, text=True, timeout=30
+        )
+        return r.stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def remux_command(video_file, audio_file, output_path, copy_video, copy_audio):
+    cmd = [FFMPEG, "-y", "-v", "error", "-i", video_file, "-i", audio_file, "-map", "0:v:0", "-map", "1:a:0"]
+    cmd += ["-c:v", "copy"] if copy_video else ["-c:v", "libx264", "-preset", "veryfast"]
+    cmd += ["-c:a", "copy"] if copy_audio else ["-c:a", "aac"]
+    cmd += ["-movflags", MP4_MOVFLAGS, "-f", "mp4", output_path]
+    return cmd
+
+def remux(video_file, audio_file, output_path):
+    # コピーで済むならコピー、失敗したら再エンコードでやり直す
+    copy_video = probe_codec(video_file, "v") in MP4_VIDEO_CODECS
+    copy_audio = probe_codec(audio_file, "a") in MP4_AUDIO_CODECS
+    attempts = [(copy_video, copy_audio)]
+    if copy_video or copy_audio:
+        attempts.append((False, False))
+
+    for copy_video, copy_audio in attempts:
+        logging.info(f"結合処理開始 (video={'copy' if copy_video else 'x264'}, audio={'copy' if copy_audio else 'aac'})")
+        r = subprocess.run(
+            remux_command(video_file, audio_file, output_path, copy_video, copy_audio),
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+        )
+        if r.returncode == 0:
+            return
+        logging.warning(f"ffmpeg 失敗: {r.stderr.decode(errors='replace')[-500:]}")
+    raise RuntimeError("ffmpeg による結合に失敗")
 
 def merge_video_audio(video_url, audio_url, output_path):
-    video_file = download_stream(video_url)
-    audio_file = download_stream(audio_url)
-
-    logging.info("結合処理開始...")
-    video_clip = VideoFileClip(video_file)
-    audio_clip = AudioFileClip(audio_file)
-    video_clip = video_clip.set_audio(audio_clip)
-    video_clip.write_videofile(output_path, codec="libx264", audio_codec="aac")
-    video_clip.close()
-    audio_clip.close()
-
-    os.unlink(video_file)
-    os.unlink(audio_file)
+    # output_path.part に書き、完成したら output_path へ rename
+    part_path = output_path + ".part"
+    video_file, audio_file = download_pair(video_url, audio_url)
+    try:
+        remux(video_file, audio_file, part_path)
+        os.replace(part_path, output_path)
+    except Exception:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+    finally:
+        os.unlink(video_file)
+        os.unlink(audio_file)
     logging.info(f"結合完了: {output_path}")
 
+class MergeJob(threading.Thread):
+    def __init__(self, filename, video_url, audio_url):
+        super().__init__(daemon=True)
+        self.filename = filename
+        self.video_url = video_url
+        self.audio_url = audio_url
+        self.output_path = video_cache.path(filename)
+        self.part_path = self.output_path + ".part"
+        self.error = None
+
+    def run(self):
+        try:
+            # 他のプロセスが作っている間はここで待ち、できていればそれを使う
+            with video_cache.lock(self.filename):
+                if video_cache.get(self.filename):
+                    return
+                merge_video_audio(self.video_url, self.audio_url, self.output_path)
+                video_cache.add(self.filename)
+        except Exception as e:
+            logging.error(f"動画結合エラー: {e}")
+            self.error = e
+        finally:
+            with merge_jobs_lock:
+                if merge_jobs.get(self.filename) is self:
+                    del merge_jobs[self.filename]
+
+    def wait_started(self, poll=0.2):
+        # .part ができる（ffmpeg が書き始める）か、終わるまで待つ
+        while self.is_alive() and not os.path.exists(self.part_path):
+            time.sleep(poll)
+
+def running_merge(filename):
+    with merge_jobs_lock:
+        return merge_jobs.get(filename)
+
+def start_merge(filename, video_url, audio_url):
+    with merge_jobs_lock:
+        job = merge_jobs.get(filename)
+        if job is None:
+            job = merge_jobs[filename] = MergeJob(filename, video_url, audio_url)
+            job.start()
+        return job
+
+def follow_part(job, chunk_size=256*1024, poll=0.1):
+    # 書き込み中の断片化MP4を追いかけて返す
+    try:
+        f = open(job.part_path, "rb")
+    except FileNotFoundError:
+        # 開く前に完成して rename 済み
+        if job.error is not None or not os.path.exists(job.output_path):
+            return
+        f = open(job.output_path, "rb")
+    with f:
+        while True:
+            data = f.read(chunk_size)
+            if data:
+                yield data
+                continue
+            if not job.is_alive():
+                # 終了後の残りを出し切る
+                data = f.read()
+                if data and job.error is None:
+                    yield data
+                return
+            if os.fstat(f.fileno()).st_size < f.tell():
+                # 再エンコードでやり直しになった（先頭から書き直し）
+                return
+            time.sleep(poll)
+
 # ===================== 動画ルート =====================
 @app.route("/video/<video_id>")
 def get_video(video_id):
-    cleanup_cache()
     quality = request.args.get("quality", "1080p")
     filename = f"{video_id}_{quality}.mp4"
-    filepath = os.path.join(CACHE_DIR, filename)
 
-    if os.path.exists(filepath):
+    if video_cache.get(filename):
         logging.info(f"キャッシュ提供: {filename}")
         return send_from_directory(CACHE_DIR, filename, as_attachment=False)
 
     try:
-        backend = request.args.get("backend", "main")
+        # 結合中なら同じジョブに相乗りする
+        job = running_merge(filename)
+        if job is None:
+            backend = request.args.get("backend", "main")
 
-        # yobi.py 専用最適化: main 以外は Omada + 高画質優先
-        if backend == "yobi":
-            stream_data = video_service.get_stream_urls(video_id, target_qualities=TARGET_QUALITIES)
-        else:
-            # 他のバックエンドもフェイルオーバーとして取得
-            stream_data = video_service.get_stream_urls(video_id)
+            # yobi.py 専用最適化: main 以外は Omada + 高画質優先
+            if backend == "yobi":
+                stream_data = get_stream_urls(video_id, target_qualities=TARGET_QUALITIES)
+            else:
+                # 他のバックエンドもフェイルオーバーとして取得
+                stream_data = get_stream_urls(video_id)
 
-        if not stream_data:
-            return jsonify({"error": "動画取得失敗"}), 404
+            if not stream_data:
+                return jsonify({"error": "動画取得失敗"}), 404
 
-        streams = stream_data['quality_streams'].get(quality)
-        if not streams or not streams.get('video_url') or not streams.get('audio_url'):
-            return jsonify({"error": f"{quality}のストリームがありません"}), 404
+            streams = stream_data['quality_streams'].get(quality)
+            if not streams or not streams.get('video_url') or not streams.get('audio_url'):
+                return jsonify({"error": f"{quality}のストリームがありません"}), 404
 
-        merge_video_audio(streams['video_url'], streams['audio_url'], filepath)
-        return send_from_directory(CACHE_DIR, filename, as_attachment=False)
+            job = start_merge(filename, streams['video_url'], streams['audio_url'])
+
+        job.wait_started()
+        if job.error:
+            raise job.error
+        if not job.is_alive():
+            return send_from_directory(CACHE_DIR, filename, as_attachment=False)
+        # 結合中でも書けた所から返す
+        return Response(follow_part(job), mimetype="video/mp4")
 
     except Exception as e:
         logging.error(f"動画結合エラー: {e}")
@@ -133,9 +381,9 @@ def get_stream_meta():
     try:
         # yobi.py最適化: 高画質優先
         if backend == "yobi":
-            stream_data = video_service.get_stream_urls(video_id, target_qualities=TARGET_QUALITIES)
+            stream_data = get_stream_urls(video_id, target_qualities=TARGET_QUALITIES)
         else:
-            stream_data = video_service.get_stream_urls(video_id)
+            stream_data = get_stream_urls(video_id)
 
         if not stream_data:
             return jsonify({"error": "動画取得失敗"}), 404
@@ -159,7 +407,7 @@ def get_stream_meta():
 @app.route("/meta/<video_id>")
 def get_meta(video_id):
     try:
-        stream_data = video_service.get_stream_urls(video_id, target_qualities=TARGET_QUALITIES)
+        stream_data = get_stream_urls(video_id, target_qualities=TARGET_QUALITIES)
         if not stream_data:
             return jsonify({"error": "動画取得失敗"}), 404
         return jsonify(stream_data)
@@ -1,13 +1,39 @@
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import FileResponse, RedirectResponse
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import FileResponse, RedirectResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
-import requests
-import random
+from contextlib import asynccontextmanager
+from typing import Union
+import asyncio
+import httpx
 import os
-import subprocess
-import uuid
+import tempfile
+
+import metrics
+from cache import cache
+from muxjobs import MuxQueue, QueueFull
+from upstream import InstancePool, Prober, UpstreamError, json_loads, race
+from videostore import VideoStore
+
+@asynccontextmanager
+async def lifespan(app):
+    global http_client
+    http_client = httpx.AsyncClient(
+        headers=HEADERS,
+        timeout=TIMEOUT,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+    )
+    if os.environ.get("PROBE", "1") != "0":
+        prober.start()
+    mux_queue.start()
+    try:
+        yield
+    finally:
+        await mux_queue.stop()
+        await prober.stop()
+        await http_client.aclose()
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(metrics.RouteMetrics)
 
 # ===============================
 # Static
@@ -33,17 +59,17 @@ def root():
 # ===============================
 # API BASE LIST
 # ===============================
-VIDEO_APIS = [
+VIDEO_APIS = (
     "https://iv.melmac.space",
     "https://pol1.iv.ggtyler.dev",
     "https://cal1.iv.ggtyler.dev",
     "https://invidious.0011.lt",
     "https://yt.omada.cafe",
-]
+)
 
 SEARCH_APIS = VIDEO_APIS
 
-COMMENTS_APIS = [
+COMMENTS_APIS = (
     "https://invidious.lunivers.trade",
     "https://invidious.ducks.party",
     "https://super8.absturztau.be",
@@ -51,29 +77,65 @@ COMMENTS_APIS = [
     "https://yt.omada.cafe",
     "https://iv.melmac.space",
     "https://iv.duti.dev",
-]
+)
 
 EDU_STREAM_API_BASE_URL = "https://raw.githubusercontent.com/toka-kun/Education/refs/heads/main/keys/key1.json"
 STREAM_YTDL_API_BASE_URL = "https://yudlp.vercel.app/stream/"
 SHORT_STREAM_API_BASE_URL = "https://yt-dl-kappa.vercel.app/short/"
 
-TIMEOUT = 6
+TIMEOUT = 6          # 1インスタンスあたり
+RACE_TIMEOUT = 10    # 1リクエスト全体
 
 HEADERS = {
     "User-Agent": "Mozilla/5.0"
 }
 
+# ===============================
+# Health（バックグラウンドで死活監視・順位付け）
+# ===============================
+# 一覧はタプル（固定）。順番は InstancePool がスコアから毎回新しく作る
+video_pool = InstancePool(
+    "VIDEO_APIS", VIDEO_APIS,
+    width=int(os.environ.get("HEDGE_VIDEO_WIDTH", 2)),
+)
+comments_pool = InstancePool(
+    "COMMENTS_APIS", COMMENTS_APIS,
+    width=int(os.environ.get("HEDGE_COMMENTS_WIDTH", 3)),
+)
+
+http_client = None
+
+prober = Prober(
+    [
+        (video_pool, "search"),
+        (video_pool, "videos"),
+        (video_pool, "channels"),
+        (comments_pool, "comments"),
+    ],
+    lambda: http_client,
+    interval=int(os.environ.get("PROBE_INTERVAL", 120)),
+    path=os.environ.get("SCOREBOARD_PATH", "scoreboard_yobiyobi.json"),
+)
+
 # ===============================
 # Utils
 # ===============================
-def try_json(url, params=None):
+async def race_json(pool, capability, path, params=None, valid=bool):
+    # 上位のインスタンスに並行して投げ、最初に valid な JSON を返したものを使う
+    # 戻り値: (data, base)。全滅なら None
+    async def fetch(base):
+        r = await http_client.get(f"{base}{path}", params=params)
+        r.raise_for_status()
+        data = json_loads(r.content)
+        if not valid(data):
+            raise ValueError(f"unexpected response from {base}")
+        return data, base
+
     try:
-        r = requests.get(url, params=params, headers=HEADERS, timeout=TIMEOUT)
-        if r.status_code == 200:
-            return r.json()
-    except Exception as e:
+        return await race(pool, fetch, timeout=RACE_TIMEOUT, capability=capability)
+    except UpstreamError as e:
         print("request error:", e)
-    return None
+        return None
 
 def pick_video_audio(formats, quality="best"):
     video_url = None
@@ -95,12 +157,12 @@ def pick_video_audio(formats, quality="best"):
 
     return video_url, audio_url
 
-def mux_video_audio_ios(video_url, audio_url):
-    out = f"/tmp/{uuid.uuid4()}.mp4"
-
-    cmd = [
+def mux_command_ios(video_url, audio_url, out):
+    # 断片化MP4（書きながら先頭から再生できる）
+    return [
         "ffmpeg",
         "-y",
+        "-v", "error",
         "-i", video_url,
         "-i", audio_url,
         "-map", "0:v:0",
@@ -110,99 +172,134 @@ def mux_video_audio_ios(video_url, audio_url):
         "-level", "3.1",
         "-pix_fmt", "yuv420p",
         "-c:a", "aac",
-        "-movflags", "+faststart",
+        "-movflags", "+frag_keyframe+empty_moov+default_base_moof",
+        "-f", "mp4",
         out
     ]
 
-    subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-
-    return out
+# 同時に動かす ffmpeg の数と待ち行列の長さ（超えたら 503）
+mux_queue = MuxQueue(
+    os.environ.get("MUX_DIR", os.path.join(tempfile.gettempdir(), "yobiyobi-mux")),
+    workers=int(os.environ.get("MUX_WORKERS", 2)),
+    max_queue=int(os.environ.get("MUX_QUEUE", 8)),
+)
 
 # ===============================
 # Search
 # ===============================
-@app.get("/api/search")
-def api_search(q: str):
-    results = []
-    random.shuffle(SEARCH_APIS)
+def video_results(data):
+    if not isinstance(data, list):
+        return []
+    return [
+        {
+            "videoId": v.get("videoId"),
+            "title": v.get("title"),
+            "author": v.get("author"),
+            "authorId": v.get("authorId"),
+        }
+        for v in data
+        if isinstance(v, dict) and v.get("videoId")
+    ]
 
-    for base in SEARCH_APIS:
-        data = try_json(f"{base}/api/v1/search", {"q": q, "type": "video"})
-        if not isinstance(data, list):
-            continue
+@app.get("/api/search")
+async def api_search(q: str):
+    found = await race_json(
+        video_pool, "search", "/api/v1/search",
+        {"q": q, "type": "video"},
+        valid=video_results
+    )
+    if not found:
+        raise HTTPException(status_code=503, detail="Search unavailable")
+
+    data, base = found
+    results = video_results(data)
+    return {
+        "count": len(results),
+        "results": results,
+        "source": base
+    }
 
-        for v in data:
-            if not v.get("videoId"):
-                continue
+# ===============================
+# Video Info（全 video 系ルート共通のメタデータストア）
+# ===============================
+async def fetch_video(video_id):
+    found = await race_json(video_pool, "videos", f"/api/v1/videos/{video_id}")
+    if not found:
+        raise HTTPException(status_code=503, detail="Video info unavailable")
+    data, base = found
+    return dict(data, source=base)
 
-            results.append({
-                "videoId": v.get("videoId"),
-                "title": v.get("title"),
-                "author": v.get("author"),
-                "authorId": v.get("authorId"),
-            })
+video_store = VideoStore(fetch_video)
+metrics.REGISTRY.watch_cache("video_store", video_store)
 
-        if results:
-            return {
-                "count": len(results),
-                "results": results,
-                "source": base
-            }
+async def get_video_data(video_id, detail="Video info unavailable"):
+    try:
+        return await video_store.get(video_id)
+    except HTTPException:
+        raise HTTPException(status_code=503, detail=detail)
 
-    raise HTTPException(status_code=503, detail="Search unavailable")
+@app.get("/api/video")
+async def api_video(video_id: str):
+    data = await get_video_data(video_id)
+    return {
+        "title": data.get("title"),
+        "author": data.get("author"),
+        "description": data.get("description"),
+        "viewCount": data.get("viewCount"),
+        "lengthSeconds": data.get("lengthSeconds"),
+        "source": data["source"]
+    }
 
 # ===============================
-# Video Info
+# Comments
 # ===============================
-@app.get("/api/video")
-def api_video(video_id: str):
-    random.shuffle(VIDEO_APIS)
-
-    for base in VIDEO_APIS:
-        data = try_json(f"{base}/api/v1/videos/{video_id}")
-        if data:
-            return {
-                "title": data.get("title"),
-                "author": data.get("author"),
-                "description": data.get("description"),
-                "viewCount": data.get("viewCount"),
-                "lengthSeconds": data.get("lengthSeconds"),
-                "source": base
+@cache(seconds=300, max_size=512)
+async def fetch_comments_page(video_id, continuation=None):
+    params = {"continuation": continuation} if continuation else None
+    found = await race_json(comments_pool, "comments", f"/api/v1/comments/{video_id}", params)
+    if not found:
+        # 失敗はキャッシュしない
+        raise LookupError(video_id)
+    data, base = found
+    return {
+        "comments": [
+            {
+                "author": c.get("author"),
+                "content": c.get("content")
             }
+            for c in data.get("comments", [])
+        ],
+        "continuation": data.get("continuation"),
+        "source": base
+    }
 
-    raise HTTPException(status_code=503, detail="Video info unavailable")
+# 次ページの先読み
+comment_prefetches = set()
+
+def prefetch_next_comments(video_id, continuation):
+    task = asyncio.ensure_future(fetch_comments_page(video_id, continuation))
+    comment_prefetches.add(task)
+    task.add_done_callback(lambda t: (comment_prefetches.discard(t), t.cancelled() or t.exception()))
 
-# ===============================
-# Comments
-# ===============================
 @app.get("/api/comments")
-def api_comments(video_id: str):
-    for base in COMMENTS_APIS:
-        data = try_json(f"{base}/api/v1/comments/{video_id}")
-        if data:
-            return {
-                "comments": [
-                    {
-                        "author": c.get("author"),
-                        "content": c.get("content")
-                    }
-                    for c in data.get("comments", [])
-                ],
-                "source": base
-            }
-    return {"comments": [], "source": None}
+async def api_comments(video_id: str, continuation: Union[str, None] = None):
+    try:
+        page = await fetch_comments_page(video_id, continuation or None)
+    except LookupError:
+        return {"comments": [], "continuation": None, "source": None}
+
+    if page["continuation"]:
+        prefetch_next_comments(video_id, page["continuation"])
+    return page
 
 # ===============================
 # Channel（完全版・修整済）
 # ===============================
 @app.get("/api/channel")
-def api_channel(c: str):
-    random.shuffle(VIDEO_APIS)
-
-    for base in VIDEO_APIS:
-        ch = try_json(f"{base}/api/v1/channels/{c}")
-        if not ch:
-            continue
+async def api_channel(c: str):
+    found = await race_json(video_pool, "channels", f"/api/v1/channels/{c}")
+    if found:
+        ch, base = found
 
         latest_videos = []
 
@@ -278,67 +375,68 @@ def api_channel(c: str):
 # Stream（iOS対応・映像＋音声合成）
 # ===============================
 @app.get("/api/stream")
-def api_stream(video_id: str, quality: str = "best"):
-    for base in VIDEO_APIS:
-        data = try_json(f"{base}/api/v1/videos/{video_id}")
-        if not data:
-            continue
+async def api_stream(video_id: str, quality: str = "best"):
+    data = await get_video_data(video_id, "Stream unavailable")
 
-        video_url, audio_url = pick_video_audio(
-            data.get("adaptiveFormats", []),
-            quality
-        )
+    video_url, audio_url = pick_video_audio(
+        data.get("adaptiveFormats", []),
+        quality
+    )
 
-        if not video_url or not audio_url:
-            continue
-
-        output = mux_video_audio_ios(video_url, audio_url)
+    if not video_url or not audio_url:
+        raise HTTPException(status_code=503, detail="Stream unavailable")
 
-        return FileResponse(
-            output,
-            media_type="video/mp4",
-            filename=f"{video_id}.mp4"
+    try:
+        job = mux_queue.submit(
+            (video_id, quality),
+            lambda out: mux_command_ios(video_url, audio_url, out)
         )
+    except QueueFull:
+        raise HTTPException(status_code=503, detail="Stream busy", headers={"Retry-After": "10"})
 
-    raise HTTPException(status_code=503, detail="Stream unavailable")
+    if not await mux_queue.wait_output(job):
+        raise HTTPException(status_code=503, detail="Stream unavailable")
+
+    return StreamingResponse(
+        mux_queue.stream(job),
+        media_type="video/mp4",
+        headers={"Content-Disposition": f'attachment; filename="{video_id}.mp4"'}
+    )
 
 # ===============================
 # Stream URL ONLY（JSON）
 # ===============================
 @app.get("/api/streamurl")
-def api_streamurl(video_id: str, quality: str = "best"):
-    for base in VIDEO_APIS:
-        data = try_json(f"{base}/api/v1/videos/{video_id}")
-        if not data:
-            continue
+async def api_streamurl(video_id: str, quality: str = "best"):
+    data = await get_video_data(video_id, "Stream unavailable")
+
+    video_url = None
+    audio_url = None
 
-        video_url = None
-        audio_url = None
-
-        for f in data.get("adaptiveFormats", []):
-            if f.get("type", "").startswith("video") and f.get("url"):
-                label = f.get("qualityLabel") or ""
-                if quality == "best" or quality in label:
-                    video_url = f["url"]
-                    break
-
-        for f in data.get("adaptiveFormats", []):
-            if f.get("type", "").startswith("audio") and f.get("url"):
-                lang = (f.get("language") or "").lower()
-                audio_track = str(f.get("audioTrack") or "").lower()
-                if "en" in lang:
-                    continue
-                if "english" in audio_track:
-                    continue
-                audio_url = f["url"]
+    for f in data.get("adaptiveFormats", []):
+        if f.get("type", "").startswith("video") and f.get("url"):
+            label = f.get("qualityLabel") or ""
+            if quality == "best" or quality in label:
+                video_url = f["url"]
                 break
 
-        if video_url and audio_url:
-            return {
-                "video": video_url,
-                "audio": audio_url,
-                "source": base
-            }
+    for f in data.get("adaptiveFormats", []):
+        if f.get("type", "").startswith("audio") and f.get("url"):
+            lang = (f.get("language") or "").lower()
+            audio_track = str(f.get("audioTrack") or "").lower()
+            if "en" in lang:
+                continue
+            if "english" in audio_track:
+                continue
+            audio_url = f["url"]
+            break
+
+    if video_url and audio_url:
+        return {
+            "video": video_url,
+            "audio": audio_url,
+            "source": data["source"]
+        }
 
     raise HTTPException(status_code=503, detail="Stream unavailable")
 
@@ -346,29 +444,36 @@ def api_streamurl(video_id: str, quality: str = "best"):
 # Stream URL ONLY（yobiyobi・旧方式）
 # ===============================
 @app.get("/api/streamurl/yobiyobi")
-def api_streamurl_yobiyobi(video_id: str, quality: str = "best"):
-    for base in VIDEO_APIS:
-        data = try_json(f"{base}/api/v1/videos/{video_id}")
-        if not data:
-            continue
+async def api_streamurl_yobiyobi(video_id: str, quality: str = "best"):
+    data = await get_video_data(video_id, "Stream unavailable")
 
-        for f in data.get("adaptiveFormats", []):
-            if not f.get("url"):
-                continue
+    for f in data.get("adaptiveFormats", []):
+        if not f.get("url"):
+            continue
 
-            label = f.get("qualityLabel") or ""
-            lang = (f.get("language") or "").lower()
-            audio_track = str(f.get("audioTrack") or "").lower()
+        label = f.get("qualityLabel") or ""
+        lang = (f.get("language") or "").lower()
+        audio_track = str(f.get("audioTrack") or "").lower()
 
-            if "en" in lang:
-                continue
-            if "english" in audio_track:
-                continue
+        if "en" in lang:
+            continue
+        if "english" in audio_track:
+            continue
 
-            if quality == "best" or quality in label:
-                return RedirectResponse(f["url"])
+        if quality == "best" or quality in label:
+            return RedirectResponse(f["url"])
 
     raise HTTPException(status_code=503, detail="Stream unavailable")
 
+# ===============================
+# Metrics（Prometheus）
+# ===============================
+if metrics.endpoint_enabled():
+    @app.get("/metrics")
+    async def metrics_endpoint(request: Request, token: Union[str, None] = None):
+        if not metrics.authorized(request.headers.get("authorization"), token):
+            raise HTTPException(status_code=403)
+        return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
 from music import router as music_router
 app.include_router(music_router)